@@ -27,13 +27,12 @@
 
 import os
 from collections import OrderedDict
-from emtable import Table
 import time
 import copy
 
 from pyworkflow.object import Float
 from pwem.constants import ALIGN_PROJ, ALIGN_2D, ALIGN_NONE
-from pwem.objects import Micrograph, MovieAlignment, Movie, Particle
+from pwem.objects import Micrograph, MovieAlignment, Movie, Particle, CTFModel, Acquisition
 import pwem.emlib.metadata as md
 import pyworkflow.utils as pwutils
 from relion.convert.convert_deprecated import setupCTF
@@ -41,9 +40,16 @@ from relion.convert.convert_deprecated import setupCTF
 from relion.convert.convert_utils import relionToLocation, locationToRelion
 from relion.convert.convert_deprecated import rowToParticle, rowToCoordinate, rowToCtfModel
 
+from .import_utils import BinaryLinker, SharedBinaryCache, StackValidator, StarRowReader, getStarHeader, ColumnarSidecar, loadSidecarColumns
+
+#Maximum number of CTF models kept in the importer cache
+CTF_CACHE_SIZE = 10000
+#Number of threads used to create the links (or copies) of the binary files
+LINK_THREADS = 8
+
 class WARPimporter:
     """ Helper class to import WARP-generated particles in streaming mode """
-    def __init__(self, protocol, starFile, partSet, micSet=None, coordSet=None, movieSet=None, ctfSet=None, importAlignments=False):
+    def __init__(self, protocol, starFile, partSet, micSet=None, coordSet=None, movieSet=None, ctfSet=None, importAlignments=False, deferAuxiliary=False, sidecarPath=None):
         self.protocol = protocol
         self._starFile = starFile
         self.copyOrLink = self.protocol.copyBinaries.get()
@@ -63,8 +69,71 @@ class WARPimporter:
         self._importAlignments = importAlignments
         self._importedCoords = set()
         self.acqRow = None
+        #Acquisition of every optics group, used when the star file has more than one
+        self._groupAcquisitions = {}
+        #Stacks still being written by WARP are detected and their particles are imported later
+        self._stackValidator = StackValidator() if self.protocol.validateStacks.get() else None
+        #CTF models are built once per micrograph (and defocus values) and shared by its particles
+        self._ctfCache = {}
+        self._compactCtf = self.protocol.compactParticleCtf.get()
+        #If deferAuxiliary is True, the coordinates are not imported with the particles,
+        #but taken from the particle set when materializeDeferredSets() is called.
+        self._deferAuxiliary = deferAuxiliary
+        #The star file is read incrementally, and rows that cannot be imported yet are kept to try again
+        self._rowReader = None
+        #Keyed by image name, since a star file that is replaced or rewritten is read again from the start
+        self._pendingRows = OrderedDict()
+        #The binary files found in one iteration are linked (or copied) together at the end of it
+        self._linker = BinaryLinker(pwutils.createLink, self._getCopyFunction(), LINK_THREADS)
+        #If sidecarPath is given, the rows of the imported particles are also written as columns to it
+        #The rows are kept until the particle set is committed (see commitSidecar)
+        self._sidecar = None
+        self._sidecarRows = []
+        if sidecarPath is not None:
+            self._sidecar = ColumnarSidecar(sidecarPath)
+            self._loadImportedNames(sidecarPath)
         self._initSets()
 
+    def _getCopyFunction(self):
+        '''With a shared cache, binaries are copied into the cache and linked from it'''
+        cachePath = self.protocol.sharedCachePath.get()
+        if not self.protocol.copyBinaries.get() or not cachePath:
+            return pwutils.copyFile
+        cache = SharedBinaryCache(cachePath, self.protocol._getPath())
+        removed = cache.collect()
+        if removed:
+            self.protocol.info("Removed {} unused files from the shared binary cache".format(removed))
+        return lambda source, destination: pwutils.createLink(cache.fetch(source), destination)
+
+    def _loadImportedNames(self, sidecarPath):
+        '''When continuing an import, the particles already in the sidecar are not imported again'''
+        names = loadSidecarColumns(sidecarPath, ['rlnImageName']).get('rlnImageName')
+        if names is None or self.partSet is None:
+            return
+        #The sidecar is written right before the particle set is committed, so it can only have
+        #more rows than the set, which were not committed and will be imported again
+        size = self.partSet.getSize()
+        if len(names) > size:
+            self.protocol.warning("The column cache has {} particles and the output {}, truncating it".format(len(names), size))
+            self._sidecar.truncate(size)
+        elif len(names) < size:
+            self.protocol.warning("The column cache has {} particles and the output {}, discarding it".format(len(names), size))
+            self._sidecar.truncate(0)
+            return
+        for name in names[:size]:
+            self._imgDict[name.decode()] = None
+
+    def countPendingRows(self):
+        '''Number of rows read from the star file that could not be imported yet'''
+        return len(self._pendingRows)
+
+    def commitSidecar(self):
+        '''Write the rows of the particles imported since the last call to the sidecar.
+        It is called right before the particle set is committed'''
+        if self._sidecarRows:
+            self._sidecar.append(self._starHeader.columns, self._sidecarRows)
+            self._sidecarRows = []
+
     def _initSets(self):
         '''This function prepares the particle, coordinate, movie and micrographs sets'''
         if self.acqRow is None:
@@ -83,7 +152,8 @@ class WARPimporter:
             self.partSet.setObjComment('Particles imported from Relion star file:\n%s' % self._starFile)
             self.partSet.enableAppend()
             if self.partSet.getSize() > 0:
-                self.micSet.loadAllProperties()
+                if self.micSet is not None:
+                    self.micSet.loadAllProperties()
             else:
                 self.loadAcquisitionInfo(self.partSet)
                 self.partSet.setSamplingRate(self.acquisitionDict['samplingRate'])
@@ -116,29 +186,31 @@ class WARPimporter:
             self._starFile,
             preprocessImageRow=self._preprocessImageRow30,
             postprocessImageRow=self._postprocessImageRow30,
-            readAcquisition=False)
-        if self.coordSet is not None:
+            readAcquisition=False,
+            readCtf=False)
+        if self.coordSet is not None and not self._deferAuxiliary:
             self.coordSet.setBoxSize(self.partSet.getDimensions()[0])
         self._importedParticles = newFiles
         self.protocol.info("Added {} new particles".format(str(len(newFiles))))
+        return newFiles
 
     def _findImagesPath(self, label, warnings=True):
         '''This function validates the input path for the binaries and gets the acquisition settings from the first row'''
-        # read the first table
-        table = Table(fileName=self._starFile)
-        acqRow = row = table[0]
+        # read only the optics table and the first particle, the header is cached
+        self._starHeader = getStarHeader(self._starFile)
+        acqRow = row = self._starHeader.firstRow
         if row is None:
             raise Exception("Cannot import from empty metadata: %s"
                             % self._starFile)
 
-        if not row.get('rlnOpticsGroup', False):
+        if not self._starHeader.optics:
             self.version30 = True
             self.protocol.warning("Import from Relion version < 3.1 ...")
         else:
-            acqRow = OpticsGroups.fromStar(self._starFile)
-            # read particles table
-            table = Table(fileName=self._starFile, tableName='particles')
-            row = table[0]
+            acqRow = self._starHeader.optics[0]
+            if len(self._starHeader.optics) > 1:
+                self.protocol.warning("Found {} optics groups. The acquisition of the first one is used for the output sets, "
+                                      "and the particles keep the acquisition of their own group.".format(len(self._starHeader.optics)))
 
         if not row.get(label, False):
             raise Exception("Label *%s* is missing in metadata: %s"
@@ -166,7 +238,13 @@ class WARPimporter:
 
         #Create a link or copy the particle binary files (*.mrcs). If the file already exists, does nothing
         self.copyOrLinkBinary(imgRow, 'rlnImageName', self._imgPath, self.protocol._getExtraPath(), copyFiles=self.protocol.copyBinaries.get())
-        setupCTF(imgRow, self.acquisitionDict['samplingRate'])
+        samplingRate = self.acquisitionDict['samplingRate']
+        if len(self._starHeader.optics) > 1:
+            acquisition, groupDict = self.getGroupAcquisition(imgRow.get('rlnOpticsGroup', None))
+            if acquisition is not None:
+                img.setAcquisition(acquisition)
+                samplingRate = groupDict.get('samplingRate', samplingRate)
+        setupCTF(imgRow, samplingRate)
 
         movieId = imgRow.get('rlnMicrographId', None)
         movieName = imgRow.get('rlnMicrographName', None)
@@ -191,59 +269,107 @@ class WARPimporter:
                     alignment = self.getMicrographAlignment(movie)
                     if alignment:
                         movie.setAlignment(alignment)
-                        self.movieSet.append(movie)
+                        self._appendItem(self.movieSet, movie)
                         # Update dict with new movie
                         self._movieDict[movieKey] = movie
                         self._importedMovies.add(movieKey)
                     else:
                         self.preprocess_success = False
                 else:
-                    self.movieSet.append(movie)
+                    self._appendItem(self.movieSet, movie)
                     # Update dict with new movie
                     self._movieDict[movieKey] = movie
                     self._importedMovies.add(movieKey)
 
 
-        if self.micSet is not None:
-            imgRow['rlnMicrographName'] = self.fixMicName(imgRow['rlnMicrographName'])
-            micName = imgRow.get('rlnMicrographName', None)
-            micId = imgRow.get('rlnMicrographId', None)
-            # Check which is the key to identify micrographs (id or name)
-            if micId is not None:
-                micKey = micId
-            else:
-                micKey = micName
+        #The micrographs are always tracked, since they give the micrograph id of the particles,
+        #even if the micrographs are not an output of the protocol
+        imgRow['rlnMicrographName'] = self.fixMicName(imgRow['rlnMicrographName'])
+        micName = imgRow.get('rlnMicrographName', None)
+        micId = imgRow.get('rlnMicrographId', None)
+        # Check which is the key to identify micrographs (id or name)
+        if micId is not None:
+            micKey = micId
+        else:
+            micKey = micName
 
-            # First time I found this micrograph (either by id or name)
-            if micKey not in self._importedMicrographs:
+        # First time I found this micrograph (either by id or name)
+        if micKey not in self._importedMicrographs:
+            if self.micSet is not None:
                 self.copyOrLinkBinary(imgRow, 'rlnMicrographName', self._imgPath, self.protocol._getExtraPath(), copyFiles=self.protocol.copyBinaries.get())
-                micName = imgRow.get('rlnMicrographName', None)
-                mic = Micrograph()
-                mic.setObjId(micId)
-                if micName is None:
-                    micName = self.protocol._getExtraPath('fake_micrograph%6d' % micId)
-                mic.setFileName(micName)
-                mic.setMicName(movieName)
-                ctf = rowToCtfModel(imgRow)
-                ctf.setMicrograph(mic)
-                self.ctfSet.append(ctf)
-                mic.setCTF(rowToCtfModel(imgRow))
-                self.micSet.append(mic)
-                self._micDict[os.path.basename(movieName)] = mic
-                self._importedMicrographs.add(micKey)
-            else:
-                mic = self._micDict.get(os.path.basename(movieName))
-                movieName = mic.getMicName()
+            micName = imgRow.get('rlnMicrographName', None)
+            #Without a set to append to (now), the micrograph id is given here
+            if micId is None and self.micSet is None:
+                micId = len(self._importedMicrographs) + 1
+            mic = Micrograph()
+            mic.setObjId(micId)
+            if micName is None:
+                micName = self.protocol._getExtraPath('fake_micrograph%6d' % micId)
+            mic.setFileName(micName)
+            mic.setMicName(movieName)
+            ctf = self.getCtfModel(imgRow, micKey)
+            mic.setCTF(ctf)
+            if self.ctfSet is not None:
+                #The CTF set entry points to its micrograph, so it cannot be shared with the particles
+                micCtf = ctf.clone()
+                micCtf.setMicrograph(mic)
+                self._appendItem(self.ctfSet, micCtf)
+            self._appendItem(self.micSet, mic)
+            self._micDict[os.path.basename(movieName)] = mic
+            self._importedMicrographs.add(micKey)
+        else:
+            mic = self._micDict.get(os.path.basename(movieName))
+            movieName = mic.getMicName()
+
+        # Update the row to set a MDL_MICROGRAPH_ID
+        imgRow['rlnMicrographId'] = int(mic.getObjId())
+        imgRow['rlnMicrographName'] = movieName
+        img.setCTF(self.getParticleCtfModel(imgRow, micKey))
+        self.preprocess_success = True
+
+    #Append an item to an output set, if it is imported
+    def _appendItem(self, outputSet, item):
+        if outputSet is not None:
+            outputSet.append(item)
+
+    #Populate the deferred coordinates from the committed particle set
+    def materializeDeferredSets(self):
+        self._initSets()
+        if self.coordSet is not None:
+            for particle in self.partSet.iterItems():
+                if particle.hasCoordinate():
+                    coord = particle.getCoordinate().clone()
+                    coord.setObjId(None)
+                    self.coordSet.append(coord)
+            self.coordSet.setBoxSize(self.partSet.getDimensions()[0])
 
-            # Update the row to set a MDL_MICROGRAPH_ID
-            imgRow['rlnMicrographId'] = int(mic.getObjId())
-            imgRow['rlnMicrographName'] = movieName
-            img.setCTF(rowToCtfModel(imgRow))
-            self.preprocess_success = True
+    #Returns the CTF model of a row. Rows of the same micrograph and with the same defocus values share the same model
+    def getCtfModel(self, imgRow, micKey, compact=False):
+        key = (micKey, compact, imgRow.get('rlnDefocusU', None), imgRow.get('rlnDefocusV', None), imgRow.get('rlnDefocusAngle', None))
+        ctf = self._ctfCache.get(key, None)
+        if ctf is None:
+            if len(self._ctfCache) >= CTF_CACHE_SIZE:
+                self._ctfCache.clear()
+            ctf = rowToCtfModel(imgRow)
+            if compact and ctf is not None:
+                ctf = self.compactCtfModel(ctf)
+            self._ctfCache[key] = ctf
+        return ctf
+
+    def getParticleCtfModel(self, imgRow, micKey):
+        return self.getCtfModel(imgRow, micKey, compact=self._compactCtf)
+
+    #Keep only the defocus values (and phase shift) of a CTF model, which is all that is needed at particle level
+    def compactCtfModel(self, ctf):
+        compactCtf = CTFModel(defocusU=ctf.getDefocusU(), defocusV=ctf.getDefocusV(), defocusAngle=ctf.getDefocusAngle())
+        if ctf.getPhaseShift() is not None:
+            compactCtf.setPhaseShift(ctf.getPhaseShift())
+        compactCtf.standardize()
+        return compactCtf
 
     #This function imports the particle coordinates
     def _postprocessImageRow30(self, img, imgRow):
-        if self._micIdOrName is not None and self.coordSet is not None:
+        if self._micIdOrName is not None and self.coordSet is not None and not self._deferAuxiliary:
             micId = imgRow.get('rlnMicrographId', None)
             micName = imgRow.get('rlnMicrographName', None)
             partName = imgRow.get('rlnImageName',None)
@@ -263,33 +389,50 @@ class WARPimporter:
         print("Getting acquisition info")
 
         try:
-            #_, modelRow, acqRow = self._findImagesPath('rlnImageName')
-            acqRow = self.acqRow
-            #print("acqRow",acqRow)
             acquisition = micSet.getAcquisition()
-            if acqRow.get('rlnVoltage', False):
-                acquisitionDict['voltage'] = acqRow.rlnVoltage
-                acquisition.setVoltage(acquisitionDict['voltage'])
-
-            if acqRow.get('rlnAmplitudeContrast', False):
-                acquisitionDict['amplitudeContrast'] = acqRow.rlnAmplitudeContrast
-                acquisition.setAmplitudeContrast(acquisitionDict['amplitudeContrast'])
-
-            if acqRow.get('rlnSphericalAberration', False):
-                acquisitionDict['sphericalAberration'] = acqRow.rlnSphericalAberration
-                acquisition.setSphericalAberration(acquisitionDict['sphericalAberration'])
-
-            if acqRow.get('rlnDetectorPixelSize', False):
-                acquisitionDict['samplingRate'] = acqRow.rlnDetectorPixelSize
-
-            acquisition.setDosePerFrame(self.protocol.dosePerFrame.get())
-            acquisition.setMagnification(self.protocol.magnification.get())
+            acquisitionDict = self.rowToAcquisition(self.acqRow, acquisition)
             micSet.setAcquisition(acquisition)
         except Exception as ex:
             print("Error loading acquisition: ", str(ex))
 
         self.acquisitionDict = acquisitionDict
 
+    #Fill an acquisition object from an optics group row (or the first particle before Relion 3.1)
+    #and return the values as a dictionary
+    def rowToAcquisition(self, acqRow, acquisition):
+        acquisitionDict = {}
+        if acqRow.get('rlnVoltage', False):
+            acquisitionDict['voltage'] = acqRow['rlnVoltage']
+            acquisition.setVoltage(acquisitionDict['voltage'])
+
+        if acqRow.get('rlnAmplitudeContrast', False):
+            acquisitionDict['amplitudeContrast'] = acqRow['rlnAmplitudeContrast']
+            acquisition.setAmplitudeContrast(acquisitionDict['amplitudeContrast'])
+
+        if acqRow.get('rlnSphericalAberration', False):
+            acquisitionDict['sphericalAberration'] = acqRow['rlnSphericalAberration']
+            acquisition.setSphericalAberration(acquisitionDict['sphericalAberration'])
+
+        if acqRow.get('rlnImagePixelSize', False):
+            acquisitionDict['samplingRate'] = acqRow['rlnImagePixelSize']
+        elif acqRow.get('rlnDetectorPixelSize', False):
+            acquisitionDict['samplingRate'] = acqRow['rlnDetectorPixelSize']
+
+        acquisition.setDosePerFrame(self.protocol.dosePerFrame.get())
+        acquisition.setMagnification(self.protocol.magnification.get())
+        return acquisitionDict
+
+    #Return the acquisition object and values of an optics group, (None, {}) if the group is unknown
+    def getGroupAcquisition(self, groupNumber):
+        if groupNumber not in self._groupAcquisitions:
+            group = self._starHeader.getOpticsGroup(groupNumber)
+            if group is None:
+                self._groupAcquisitions[groupNumber] = (None, {})
+            else:
+                acquisition = Acquisition()
+                self._groupAcquisitions[groupNumber] = (acquisition, self.rowToAcquisition(group, acquisition))
+        return self._groupAcquisitions[groupNumber]
+
     #Returns the path to the micrograph metadata. We assume that the metadata star files are located in motion/*.star
     def getMicrographMetadata(self,micName):
         metadataName = pwutils.replaceBaseExt(micName, 'star')
@@ -302,6 +445,7 @@ class WARPimporter:
 
     #Reads the micrograph metadata and returns the movie alignment
     def getMicrographAlignment(self,movie):
+        from emtable import Table
         movieName = movie.getMicName()
         motionStar = self.getMicrographMetadata(movieName)
         if os.path.isfile(motionStar):
@@ -328,39 +472,70 @@ class WARPimporter:
                 rowToParticle: this function will be used to convert the row to Object
             """
             img = None
+            if self._rowReader is None or self._rowReader.fileName != filename:
+                self._rowReader = StarRowReader(filename)
             try:
-                imgMd = md.MetaData(filename)
-            except:
-                print("Cant't read star file, maybe drive is busy. Skipping this iteration")
+                newRows = self._rowReader.readNewRows()
+            except OSError as e:
+                self.protocol.warning("Can't read star file ({}), maybe drive is busy. Skipping this iteration".format(e))
                 return(set())
+            #Rows that could not be imported in previous iterations are tried again first
+            rows = self._pendingRows
+            for values in newRows:
+                rows[values.get('rlnImageName')] = values
+            self._pendingRows = OrderedDict()
             newFiles = set()
-            oldFiles = set(self._imgDict.keys())
-            for imgRow in md.iterRows(imgMd):
-                imgName = imgRow['rlnImageName']
-                #img = self._imgDict.get(imgName, None)
-                if imgName not in oldFiles:
-                    img = rowToParticle(imgRow, **kwargs)
+            deferredStacks = set()
+            columns = self._starHeader.columns
+            for imgName, values in rows.items():
+                if imgName not in self._imgDict:
+                    if not self.isStackComplete(imgName):
+                        deferredStacks.add(imgName.split('@')[-1])
+                        self._pendingRows[imgName] = values
+                        continue
+                    img = rowToParticle(self._toRow(values), **kwargs)
                     if not self.preprocess_success:
+                        self._pendingRows[imgName] = values
                         continue
                     self._imgDict[imgName] = img
                     newFiles.add(imgName)
                     self.partSet.append(img)
+                    if self._sidecar is not None:
+                        self._sidecarRows.append([values.get(label) for label in columns])
+
+            self._linker.flush()
 
             if not img is None:
                 self.partSet.setHasCTF(img.hasCTF())
 
+            if deferredStacks:
+                self.protocol.info("{} particle stacks are not complete yet, their particles will be imported later".format(len(deferredStacks)))
+
+            if self._rowReader.badLines:
+                self.protocol.warning("{} lines of the star file do not have a value for every column and were ignored".format(self._rowReader.badLines))
+
             return(newFiles)
 
-    #Create a symlink or copy the binary files (particles, micrographs, movies) into the Scipion project dir
+    #Build the metadata row used by rowToParticle from the values read from the star file
+    def _toRow(self, values):
+        row = md.Row()
+        for label, value in values.items():
+            row.setValue(label, value)
+        return row
+
+    #Check that the stack of a particle (index@stack) is large enough to contain it
+    def isStackComplete(self, imgName):
+        if self._stackValidator is None:
+            return True
+        index, imgPath = relionToLocation(imgName)
+        return self._stackValidator.isComplete(os.path.join(self._imgPath or "", imgPath), index)
+
+    #Point the row to the binary file (particles, micrographs, movies) in the Scipion project dir.
+    #The symlink or copy is created by self._linker.flush() at the end of the iteration
     def copyOrLinkBinary(self, imgRow, label, basePath, destBasePath ,copyFiles=False):
         index, imgPath = relionToLocation(imgRow.get(label))
         baseName = os.path.join(os.path.dirname(imgPath),os.path.basename(imgPath))
-        os.makedirs(os.path.join(destBasePath,os.path.dirname(imgPath)),exist_ok=True)
         newName = os.path.join(destBasePath, baseName)
-        if not os.path.exists(newName):
-            if copyFiles:
-                pwutils.copyFile(os.path.join(basePath, imgPath), newName)
-            else:
-                pwutils.createLink(os.path.join(basePath, imgPath), newName)
+        self._linker.add(os.path.join(basePath, imgPath), newName, copy=copyFiles)
 
         imgRow.set(label, locationToRelion(index, newName))
@@ -0,0 +1,675 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+"""
+Helpers used by the WARP importer.
+"""
+
+import hashlib
+import mmap
+import os
+import shutil
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+import numpy as np
+
+from .streaming_utils import ArrivalRate
+
+# Rows of a star file read at once are parsed by several processes above this size
+PARALLEL_PARSE_SIZE = 32 * 1024**2
+
+# The last chunks of a column cache are merged when there are this many of a similar size
+SIDECAR_MERGE_FACTOR = 4
+
+MRC_HEADER_SIZE = 1024
+# Bytes per voxel of the MRC data modes
+MRC_MODE_BYTES = {0: 1, 1: 2, 2: 4, 3: 4, 4: 8, 6: 2, 12: 2, 101: 0.5}
+
+
+def readMrcHeader(fileName):
+    """ Return nx, ny, nz, mode and the size of the extended header
+    read from the main header of an MRC file. Only the header is mapped
+    into memory, the image data is never read.
+    """
+    with open(fileName, 'rb') as f:
+        with mmap.mmap(f.fileno(), MRC_HEADER_SIZE,
+                       access=mmap.ACCESS_READ) as header:
+            # The machine stamp tells the byte order of the file
+            order = '>' if header[212] == 0x11 else '<'
+            nx, ny, nz, mode = struct.unpack(order + '4i', header[0:16])
+            nsymbt, = struct.unpack(order + 'i', header[92:96])
+    return nx, ny, nz, mode, nsymbt
+
+
+class StackValidator:
+    """ Checks that the particle stacks written by WARP are complete
+    before their particles are imported. For every stack, the number of
+    images covered by the file size is cached, so the header is only read
+    again when a higher index is requested and the file has grown.
+    """
+    def __init__(self):
+        self._images = {}
+        self._sizes = {}
+
+    def countImages(self, fileName):
+        '''Number of complete images in the stack, 0 if it cannot be read'''
+        try:
+            size = os.path.getsize(fileName)
+            if size == self._sizes.get(fileName):
+                return self._images[fileName]
+            nx, ny, nz, mode, nsymbt = readMrcHeader(fileName)
+            imageSize = nx * ny * MRC_MODE_BYTES[mode]
+            images = int((size - MRC_HEADER_SIZE - nsymbt) // imageSize)
+            images = max(min(images, nz), 0)
+        except (OSError, ValueError, KeyError, ZeroDivisionError):
+            # Missing, empty or unknown files are checked again later
+            return 0
+        self._sizes[fileName] = size
+        self._images[fileName] = images
+        return images
+
+    def isComplete(self, fileName, index):
+        '''True if the stack contains the image with the given (1-based) index'''
+        if self._images.get(fileName, 0) >= index:
+            return True
+        return self.countImages(fileName) >= index
+
+
+def _starValue(value):
+    for valueType in (int, float):
+        try:
+            return valueType(value)
+        except ValueError:
+            pass
+    return value
+
+
+class StarHeader:
+    """ Optics groups and particle columns of a RELION star file. """
+    def __init__(self, optics, columns, firstRow):
+        # List of dicts, one per optics group (empty before RELION 3.1)
+        self.optics = optics
+        # Labels of the particles table and values of its first row
+        self.columns = columns
+        self.firstRow = firstRow
+
+    def getOpticsGroup(self, number):
+        for group in self.optics:
+            if group.get('rlnOpticsGroup') == number:
+                return group
+        return None
+
+
+def readStarHeader(fileName):
+    """ Read the optics table and the header and first row of the particles
+    table of a star file. The particle rows are not parsed, so only the
+    first few KB of the file are read.
+    """
+    optics, columns, firstRow = [], [], None
+    tableName, labels, inLoop = None, [], False
+    with open(fileName) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('data_'):
+                tableName, labels, inLoop = line[5:], [], False
+            elif line.startswith('loop_'):
+                inLoop = True
+            elif line.startswith('_'):
+                labels.append(line.split()[0][1:])
+            elif inLoop and labels:
+                values = dict(zip(labels, map(_starValue, line.split())))
+                if tableName == 'optics':
+                    optics.append(values)
+                else:
+                    columns, firstRow = labels, values
+                    break
+    return StarHeader(optics, columns, firstRow)
+
+
+_starHeaders = {}
+
+
+def getStarHeader(fileName):
+    """ Same as readStarHeader, but the result is cached for every file
+    (device and inode), so a star file that keeps growing is only read once.
+    """
+    st = os.stat(fileName)
+    key = (os.path.realpath(fileName), st.st_dev, st.st_ino)
+    header = _starHeaders.get(key)
+    if header is None:
+        header = readStarHeader(fileName)
+        # Files without particles yet are read again next time
+        if header.firstRow is not None:
+            _starHeaders[key] = header
+    return header
+
+
+class ImportSession:
+    """ Follows the activity of the session that writes a star file, to
+    decide when it has to be read again and when the session is over.
+    The session is active while new particles are found or the file
+    modification time changes. The modification time is only compared with
+    its previous value, so clock differences with the file server do not
+    matter. While idle, the wait between reads doubles up to maxInterval,
+    but a last read is always done when idleTimeout is reached.
+    """
+    def __init__(self, interval, idleTimeout, maxInterval=0, now=None):
+        self.interval = interval
+        self.idleTimeout = idleTimeout
+        self.maxInterval = max(maxInterval, interval)
+        self.rate = ArrivalRate()
+        self._size = 0
+        self._mtime = None
+        self._lastActivity = time.time() if now is None else now
+        self._wait = interval
+
+    def update(self, newItems, mtime, now=None):
+        '''Register the result of a read of the file'''
+        now = time.time() if now is None else now
+        self._size += newItems
+        self.rate.update(self._size, now)
+        changed = mtime is not None and mtime != self._mtime
+        if mtime is not None:
+            self._mtime = mtime
+        if newItems or changed:
+            self._lastActivity = now
+            self._wait = self.interval
+        else:
+            self._wait = min(self._wait * 2, self.maxInterval)
+
+    def idleTime(self, now=None):
+        now = time.time() if now is None else now
+        return now - self._lastActivity
+
+    def isFinished(self, now=None):
+        return self.interval <= 0 or self.idleTime(now) >= self.idleTimeout
+
+    def nextInterval(self, now=None):
+        '''Seconds to wait before the next read, never past the idle timeout'''
+        remaining = self.idleTimeout - self.idleTime(now)
+        return max(min(self._wait, remaining), 0)
+
+
+class CommitPolicy:
+    """ Decides when the imported items are written to the output sets:
+    once there are at least rows new items, or interval seconds after the
+    last commit, whichever happens first. Nothing is written while there are
+    no new items. With both values set to zero, every read with new items
+    is committed.
+    """
+    def __init__(self, rows=0, interval=0, now=None):
+        self.rows = rows
+        self.interval = interval
+        self.pending = 0
+        self._lastCommit = time.time() if now is None else now
+
+    def add(self, newItems):
+        self.pending += newItems
+
+    def isDue(self, now=None):
+        if not self.pending:
+            return False
+        now = time.time() if now is None else now
+        if self.rows <= 0 and self.interval <= 0:
+            return True
+        return ((self.rows > 0 and self.pending >= self.rows) or
+                (self.interval > 0 and now - self._lastCommit >= self.interval))
+
+    def committed(self, now=None):
+        self.pending = 0
+        self._lastCommit = time.time() if now is None else now
+
+
+class StarRowReader:
+    """ Reads the particle rows of a star file that is still being written.
+    Only complete lines are parsed and the position after the last one is
+    kept, so every call returns the rows added since the previous one and a
+    line that is half written is read in the next call. The file is read
+    again from the start if it was replaced or rewritten in the meantime.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._reset()
+
+    def _reset(self):
+        self._fileId = None
+        self._offset = 0
+        self._lastLine = b''
+        self._tableName, self._labels, self._inLoop = None, [], False
+        # Complete lines without a value for every label in the last call
+        self.badLines = 0
+
+    def _isSameFile(self, f, st):
+        if (st.st_dev, st.st_ino) != self._fileId or st.st_size < self._offset:
+            return False
+        # The last line read must still be where it was
+        f.seek(self._offset - len(self._lastLine))
+        return f.read(len(self._lastLine)) == self._lastLine
+
+    def readNewRows(self):
+        '''Return a list of dicts (label -> value) with the rows added since the last call'''
+        with open(self.fileName, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not self._isSameFile(f, st):
+                self._reset()
+                self._fileId = (st.st_dev, st.st_ino)
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return []
+        self._offset += end
+        self._lastLine = data[data.rfind(b'\n', 0, end - 1) + 1:end]
+        self.badLines = 0
+        # The lines are parsed one by one until the first row, so the labels are known
+        rows, pos = [], 0
+        while pos < end:
+            lineEnd = data.index(b'\n', pos) + 1
+            row = self._parseLine(data[pos:lineEnd])
+            pos = lineEnd
+            if row is not None:
+                rows.append(row)
+                break
+        rest = data[pos:end]
+        # A big block of rows (e.g. when starting on a running session) is split between processes
+        if (len(rest) >= PARALLEL_PARSE_SIZE and (os.cpu_count() or 1) > 1 and
+                not rest.startswith(b'data_') and b'\ndata_' not in rest):
+            try:
+                rows.extend(self._parseRowsParallel(rest))
+                return rows
+            except (OSError, BrokenProcessPool):
+                pass
+        rows.extend(row for row in map(self._parseLine, rest.splitlines()) if row is not None)
+        return rows
+
+    def _parseRowsParallel(self, data):
+        workers = os.cpu_count() or 1
+        chunkSize = max(len(data) // (workers * 4), 1)
+        # Chunks are split at line ends
+        chunks, start = [], 0
+        while start < len(data):
+            stop = data.find(b'\n', min(start + chunkSize, len(data) - 1)) + 1
+            stop = stop or len(data)
+            chunks.append(data[start:stop])
+            start = stop
+        rows, totalBadLines = [], 0
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            for columns, badLines in pool.map(_parseStarChunk, chunks, repeat(self._labels)):
+                totalBadLines += badLines
+                rows.extend(dict(zip(self._labels, values)) for values in zip(*columns))
+        # Only counted once all the chunks are parsed, since a failed pool is
+        # parsed again in this process
+        self.badLines += totalBadLines
+        return rows
+
+    def _parseLine(self, line):
+        line = line.decode().strip()
+        if not line or line.startswith('#'):
+            return None
+        if line.startswith('data_'):
+            self._tableName, self._labels, self._inLoop = line[5:], [], False
+        elif line.startswith('loop_'):
+            self._inLoop = True
+        elif line.startswith('_'):
+            self._labels.append(line.split()[0][1:])
+        elif self._inLoop and self._labels and self._tableName != 'optics':
+            values = line.split()
+            if len(values) != len(self._labels):
+                self.badLines += 1
+                return None
+            return dict((label, _parseStarValue(label, value))
+                        for label, value in zip(self._labels, values))
+        return None
+
+
+def _parseStarValue(label, value):
+    # File names are kept as text even if they look like numbers
+    return value if label.endswith('Name') else _starValue(value)
+
+
+def _parseStarChunk(data, labels):
+    """ Parse a block of complete rows of a star file loop. Return the values
+    of every label as lists, and the number of lines without a value for
+    every label. Used by the worker processes of StarRowReader.
+    """
+    columns = [[] for _ in labels]
+    badLines = 0
+    for line in data.decode().splitlines():
+        values = line.split()
+        if not values or values[0].startswith('#'):
+            continue
+        if len(values) != len(labels):
+            badLines += 1
+            continue
+        for column, label, value in zip(columns, labels, values):
+            column.append(_parseStarValue(label, value))
+    return columns, badLines
+
+
+class BinaryLinker:
+    """ Collects the binary files (stacks, micrographs, movies) that have to
+    be linked or copied into the project and creates them together with a
+    small pool of threads. Every operation waits on the file system rather
+    than the CPU, so a few threads hide most of the latency of network
+    file systems when thousands of files arrive at once.
+    """
+    def __init__(self, link, copy, threads=8):
+        self._link = link
+        self._copy = copy
+        self.threads = threads
+        # Destination -> (source, copy) of the files to create in flush()
+        self._pending = OrderedDict()
+        self._done = set()
+
+    def add(self, source, destination, copy=False):
+        if destination not in self._done:
+            self._pending.setdefault(destination, (source, copy))
+
+    def _create(self, item):
+        destination, (source, copy) = item
+        if not os.path.exists(destination):
+            if copy:
+                self._copy(source, destination)
+            else:
+                self._link(source, destination)
+
+    def flush(self):
+        '''Create all the pending files and return how many there were'''
+        items = list(self._pending.items())
+        self._pending.clear()
+        if not items:
+            return 0
+        folders = set(os.path.dirname(destination) for destination, _ in items)
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(lambda d: os.makedirs(d, exist_ok=True), folders))
+            list(pool.map(self._create, items))
+        self._done.update(destination for destination, _ in items)
+        return len(items)
+
+
+class SharedBinaryCache:
+    """ Folder shared by several projects, where the imported binaries are
+    copied only once. The files are keyed by the real path, size and
+    modification time of their source, so a changed source gets a new copy.
+    Every protocol using an entry (owner, its working folder) is recorded
+    as a reference in a small sqlite database, together with the host that
+    wrote it. collect() drops the references of the owners of this host
+    whose folder no longer exists, and deletes the entries without
+    references. An owner folder is only checked from the host that
+    registered it, since other hosts may not mount it or may mount it at
+    another path, so all the protocols of a host must see the projects
+    folder at the same path.
+    """
+    DB_NAME = 'binary_cache.sqlite'
+
+    def __init__(self, path, owner, host=None):
+        self.path = path
+        self.owner = os.path.abspath(owner)
+        self.host = host or socket.gethostname()
+        os.makedirs(path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                         "path TEXT, source TEXT, size INTEGER, mtime REAL, "
+                         "created REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS refs (key TEXT, owner TEXT, "
+                         "host TEXT, PRIMARY KEY (key, owner))")
+            # Caches created before the host was recorded; their references
+            # are kept until their owner uses the cache again
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(refs)")]
+            if 'host' not in columns:
+                conn.execute("ALTER TABLE refs ADD COLUMN host TEXT")
+
+    def _connect(self):
+        # One connection per call, since fetch() is used from several threads
+        return sqlite3.connect(os.path.join(self.path, self.DB_NAME), timeout=60)
+
+    def fetch(self, source):
+        '''Return the path of the cached copy of source, copying it if needed'''
+        source = os.path.realpath(source)
+        st = os.stat(source)
+        key = hashlib.sha1(('%s\0%d\0%f' % (source, st.st_size, st.st_mtime)).encode()).hexdigest()
+        cached = os.path.join(self.path, key[:2], key, os.path.basename(source))
+        # The reference is added first, so collect() never removes a file being fetched
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, cached, source, st.st_size, st.st_mtime, time.time()))
+                conn.execute("INSERT OR REPLACE INTO refs (key, owner, host) VALUES (?, ?, ?)",
+                             (key, self.owner, self.host))
+        finally:
+            conn.close()
+        if not os.path.exists(cached):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            tmp = '%s.%d.%d.tmp' % (cached, os.getpid(), threading.get_ident())
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, cached)
+        return cached
+
+    def collect(self):
+        '''Remove the entries that are not used anymore and return how many there were'''
+        conn = self._connect()
+        try:
+            owners = [o for o, in conn.execute("SELECT DISTINCT owner FROM refs WHERE host=?",
+                                               (self.host,))]
+            with conn:
+                for owner in owners:
+                    if not os.path.isdir(owner):
+                        conn.execute("DELETE FROM refs WHERE owner=?", (owner,))
+                unused = conn.execute("SELECT key, path FROM entries WHERE key NOT IN "
+                                      "(SELECT key FROM refs)").fetchall()
+                for key, path in unused:
+                    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                    conn.execute("DELETE FROM entries WHERE key=?", (key,))
+        finally:
+            conn.close()
+        return len(unused)
+
+
+class ColumnarSidecar:
+    """ Append-only columnar copy of the particle rows read from the star
+    file. Every append() writes a new chunk directory with one .npy file per
+    column, which can be memory-mapped by the readers below. A chunk is
+    written under a temporary name and renamed when complete, so readers
+    never see partial chunks.
+
+    The chunks are named after their generation, first row and number of
+    rows. As in a log-structured merge tree, the last SIDECAR_MERGE_FACTOR
+    chunks are merged into one when their sizes are the same power of
+    SIDECAR_MERGE_FACTOR, so there are only a few chunks and every row is
+    copied a few times. The columns are copied through memory maps. A merged
+    chunk is complete before the chunks it replaces are removed, and readers
+    skip the chunks covered by a bigger one. truncate() writes a new
+    generation, and readers only use the last generation.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._chunks = _sidecarChunks(path)
+        self._generation = self._chunks[-1][0] if self._chunks else 0
+        self.rows = sum(chunk[2] for chunk in self._chunks)
+        # Leftovers of an interrupted merge or truncation
+        used = set(chunk[3] for chunk in self._chunks)
+        for chunkPath in _listChunkDirs(path):
+            if chunkPath not in used:
+                shutil.rmtree(chunkPath, ignore_errors=True)
+        # An empty chunk only marks the generation of a sidecar truncated to zero rows
+        self._chunks = [chunk for chunk in self._chunks if chunk[2]]
+
+    def append(self, columns, rows):
+        '''Write the rows (lists of values in the order of columns) as a new chunk'''
+        if not rows:
+            return
+        self._chunks.append(self._writeChunk(
+            self._generation, self.rows, len(rows),
+            [(label, [_toColumn([row[i] for row in rows])])
+             for i, label in enumerate(columns)]))
+        self.rows += len(rows)
+        factor = SIDECAR_MERGE_FACTOR
+        while (len(self._chunks) >= factor and
+               len(set(_chunkLevel(chunk[2]) for chunk in self._chunks[-factor:])) == 1):
+            self._chunks[-factor:] = [self._merge(self._generation, self._chunks[-factor:])]
+
+    def truncate(self, rows):
+        '''Drop the rows after the first ones'''
+        if rows >= self.rows:
+            return
+        merged = self._merge(self._generation + 1, self._chunks, rows)
+        self._generation += 1
+        self._chunks = [merged] if rows else []
+        self.rows = rows
+
+    def _merge(self, generation, chunks, rows=None):
+        '''Copy the first rows (all by default) of consecutive chunks into a
+        new chunk and remove them'''
+        if rows is None:
+            rows = sum(chunk[2] for chunk in chunks)
+        data = [_loadChunk(chunk[3]) for chunk in chunks]
+        columns = []
+        if rows:
+            for label in data[0].keys():
+                parts, remaining = [], rows
+                for chunk in data:
+                    if remaining > 0:
+                        parts.append(chunk[label][:remaining])
+                        remaining -= len(parts[-1])
+                columns.append((label, parts))
+        merged = self._writeChunk(generation, chunks[0][1] if chunks else 0,
+                                  rows, columns)
+        del data, columns
+        for chunk in chunks:
+            shutil.rmtree(chunk[3], ignore_errors=True)
+        return merged
+
+    def _writeChunk(self, generation, first, rows, columns):
+        '''Write the columns, given as lists of arrays that are joined, into
+        a new chunk and return its (generation, first row, rows, path)'''
+        chunkPath = os.path.join(self.path, 'chunk_%04d_%012d_%09d'
+                                 % (generation, first, rows))
+        tmpPath = chunkPath + '.tmp'
+        # Leftovers of an interrupted append
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        os.makedirs(tmpPath)
+        for label, parts in columns:
+            column = np.lib.format.open_memmap(os.path.join(tmpPath, label + '.npy'),
+                                               mode='w+', shape=(rows,),
+                                               dtype=np.result_type(*parts))
+            start = 0
+            for part in parts:
+                column[start:start + len(part)] = part
+                start += len(part)
+            column.flush()
+            del column
+        os.rename(tmpPath, chunkPath)
+        return (generation, first, rows, chunkPath)
+
+
+def _toColumn(values):
+    column = np.asarray(values)
+    if column.dtype.kind not in 'biuf':
+        # Strings are stored as bytes, which take a quarter of the space
+        column = np.asarray([str(v) for v in values], dtype=np.bytes_)
+    return column
+
+
+def _chunkLevel(rows):
+    level = 0
+    while rows >= SIDECAR_MERGE_FACTOR:
+        rows //= SIDECAR_MERGE_FACTOR
+        level += 1
+    return level
+
+
+def _listChunkDirs(path):
+    '''Paths of all the complete chunks of a sidecar, also the unused ones'''
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, name) for name in os.listdir(path)
+            if name.startswith('chunk_') and not name.endswith('.tmp')]
+
+
+def _sidecarChunks(path):
+    '''(generation, first row, rows, path) of the chunks that hold the rows
+    of a sidecar, in row order: the chunks of the last generation, without
+    those replaced by a merged chunk'''
+    chunks = []
+    for chunkPath in _listChunkDirs(path):
+        fields = os.path.basename(chunkPath).split('_')
+        if len(fields) == 4:
+            chunks.append(tuple(int(f) for f in fields[1:]) + (chunkPath,))
+    if not chunks:
+        return []
+    generation = max(chunk[0] for chunk in chunks)
+    selected, end = [], 0
+    # A merged chunk starts where the first chunk it replaces starts, and is bigger
+    for chunk in sorted((c for c in chunks if c[0] == generation),
+                        key=lambda c: (c[1], -c[2])):
+        if chunk[1] >= end and (chunk[2] or not selected):
+            selected.append(chunk)
+            end = chunk[1] + chunk[2]
+    return selected
+
+
+def listSidecarChunks(path):
+    '''Paths of the chunks of a sidecar, in row order'''
+    return [chunk[3] for chunk in _sidecarChunks(path)]
+
+
+def _loadChunk(chunkPath, columns=None):
+    chunk = {}
+    for fileName in os.listdir(chunkPath):
+        label = fileName[:-4]
+        if columns is None or label in columns:
+            chunk[label] = np.load(os.path.join(chunkPath, fileName), mmap_mode='r')
+    return chunk
+
+
+def iterSidecarChunks(path, columns=None):
+    """ Yield a dictionary with the (memory-mapped) columns of every chunk. """
+    for chunkPath in listSidecarChunks(path):
+        yield _loadChunk(chunkPath, columns)
+
+
+def loadSidecarColumns(path, columns=None):
+    """ Return a dictionary with the full columns of a sidecar, as arrays.
+    Only the requested columns are read if columns is given.
+    """
+    # Truncating a sidecar to zero rows leaves a chunk without columns
+    chunks = [chunk for chunk in iterSidecarChunks(path, columns) if chunk]
+    labels = chunks[0].keys() if chunks else []
+    return {label: np.concatenate([chunk[label] for chunk in chunks])
+            for label in labels}
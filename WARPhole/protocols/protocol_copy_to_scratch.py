@@ -28,15 +28,25 @@ import os
 import time
 from datetime import datetime
 import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import pyworkflow.protocol.constants as cons
 import pyworkflow.utils as pwutils
 from pyworkflow import VERSION_2_0
 from pwem.protocols import EMProtocol
-from pyworkflow.object import Set
-from pyworkflow.protocol.params import BooleanParam, IntParam, PointerParam, GT, FolderParam
+from pyworkflow.object import Set, String, Integer, Float
+from pyworkflow.protocol.params import BooleanParam, IntParam, PointerParam, StringParam, GT, GE, FolderParam
 from xmipp3.protocols.protocol_trigger_data import XmippProtTriggerData
 
+from .streaming_utils import ensureIndexes, CREATION_INDEX, SetEvents
+from .scratch_utils import repackImages, transformStack, fastCopyFile, rankScratchRoots, getStagedFilename, StagingTransform, StagingManifest
+
+#Maximum size of the stacks written when the particles are repacked
+REPACKED_STACK_SIZE = 4 * 1024**3
+#Number of stacks copied at the same time to every scratch directory
+COPY_THREADS_PER_ROOT = 2
+
 class CopyToScratch(XmippProtTriggerData):
     """
 	Moves particle mrcs files to the scratch drive.
@@ -78,6 +88,37 @@ class CopyToScratch(XmippProtTriggerData):
 
         form.addParam('scratchPath', FolderParam, label="Scratch directory", important=True, condition='(revert == False)')
 
+        form.addParam('extraScratchPaths', StringParam, default='', condition='(revert == False)',
+                      label='Additional scratch directories',
+                      help="Other scratch directories (e.g. on other local disks), separated by spaces. "
+                           "The stacks are spread over all the scratch directories and copied to them in parallel. "
+                           "Every stack always goes to the same directory, unless it does not have enough free space.")
+
+        form.addParam('scratchWeights', StringParam, default='', condition='(revert == False)',
+                      label='Scratch directory weights',
+                      help="Relative share of the stacks for every scratch directory, separated by spaces, "
+                           "starting with the main one (e.g. the capacity of the disks in TB). Leave empty to use the same weight for all.")
+
+        form.addParam('repack', BooleanParam, default=False, condition='(revert == False)',
+                      label='Repack particles into large stacks?',
+                      help="If NO, the particle stacks are copied to the scratch drive as they are.\n"
+                           "If YES, the new particles are written one after another into a few large stacks on the scratch drive "
+                           "once there are at least 'Minimum output size' of them (or the input is closed), so downstream jobs read a few files sequentially instead of opening thousands of small stacks. "
+                           "The original location of every particle is kept in the output set, so the repacked particles can also be reverted.")
+
+        form.addParam('stageFloat16', BooleanParam, default=False, condition='(revert == False)',
+                      label='Convert particles to float16?',
+                      help="If YES, the particles are written to the scratch drive as 16-bit floats (MRC mode 12), "
+                           "which halves the space and reading time of float32 stacks. "
+                           "The programs that read the particles must support this MRC mode.")
+
+        form.addParam('stageBoxSize', IntParam, default=0, condition='(revert == False)',
+                      validators=[GE(0)],
+                      label='Downsample particles to box (px)',
+                      help="If larger than zero, the particles are Fourier-cropped to this (even) box size while they are "
+                           "copied to the scratch drive. The pixel size of the output and the particle shifts are updated accordingly. "
+                           "Set to zero to keep the original size.")
+
         form.addParam('outputSize', IntParam, default=10000, condition='(revert == False)',
                       label='Minimum output size',
                       help='How many particles need to be on input to '
@@ -105,30 +146,46 @@ class CopyToScratch(XmippProtTriggerData):
         self.lastCheck = getattr(self, 'lastCheck', datetime.now())
         mTime = datetime.fromtimestamp(os.path.getmtime(imsFile))
 
+        # WARPhole producers write an event when they commit new images, so
+        # without new events there is nothing new in the input
+        inputEvents = getattr(self, '_inputEvents', None) or SetEvents(imsFile)
+        self._inputEvents = inputEvents
+        if inputEvents.exists() and not inputEvents.read() and hasattr(self, 'newImages'):
+            return None
+
         # If the input's sqlite have not changed since our last check,
         # it does not make sense to check for new input data
         if self.lastCheck > mTime and hasattr(self, 'newImages'):
             return None
 
+        # the new images are queried by creation date, which needs an index
+        # to be fast in big sets. It is created once, when the set has items
+        if not getattr(self, '_inputIndexed', False):
+            self._inputIndexed = ensureIndexes(imsFile, CREATION_INDEX)
+
         # loading the input set in a dynamic way
         inputClass = self.getImagesClass()
         self.imsSet = inputClass(filename=imsFile)
         self.imsSet.loadAllProperties()
 
         # loading new images to process
-        if len(self.images) > 0:  # taking the non-processed yet
-            self.newImages = [m.clone() for m in self.imsSet.iterItems(
+        repackPending = getattr(self, '_repackPending', [])
+        if len(self.images) > 0 or repackPending:  # taking the non-processed yet
+            loadedImages = [m.clone() for m in self.imsSet.iterItems(
                 orderBy='creation',
                 where='creation>"' + str(self.check) + '"')]
         else:  # first time
-            self.newImages = [m.clone() for m in self.imsSet]
+            loadedImages = [m.clone() for m in self.imsSet]
+        self.newImages = loadedImages
         if self.revert:
             self._revertImages(self.newImages)
+        elif self.repack:
+            self.newImages = self._takeRepackBatch(loadedImages, self.imsSet.isStreamClosed())
         else:
             self._moveImages(self.newImages)
         self.splitedImages = self.splitedImages + self.newImages
         self.images = self.images + self.newImages
-        if len(self.newImages) > 0:
+        if len(loadedImages) > 0:
             for item in self.imsSet.iterItems(orderBy='creation',
                                               direction='DESC'):
                 self.check = item.getObjCreation()
@@ -142,36 +199,208 @@ class CopyToScratch(XmippProtTriggerData):
         self._fillingOutput()
 
     def _moveImages(self,imgSet):
-        scratchPath = str(self.scratchPath)
+        scratchRoots = self._getScratchRoots()
         imgSetSize = self._getImgSetSize(imgSet)
-        freeScratchSpace = self._getFreeScratchSpace(scratchPath)
+        freeScratchSpace = sum(self._getFreeScratchSpace(root) for root in scratchRoots)
         self.info("imgSetSize: {}, freeScratchSpace: {}".format(str(imgSetSize),str(freeScratchSpace)))
         while imgSetSize > freeScratchSpace:
             time.sleep(60)
-            freeScratchSpace = self._getFreeScratchSpace(scratchPath)
+            freeScratchSpace = sum(self._getFreeScratchSpace(root) for root in scratchRoots)
             self.info("Not enough scratch space available. Sleeping for 60 seconds")
-        for img in imgSet:
-            filename = img.getFileName()
-            if not filename.startswith(scratchPath):
-                newFilename = os.path.join(scratchPath,filename)
-            else:
-                newFilename = filename
-            pwutils.path.makeFilePath(newFilename)
-            symlink = self._getExtraPath(filename)
+        transform = self._getStagingTransform()
+        if self.repack:
+            self._repackImages(imgSet)
+        else:
+            #Every stack is only staged once, and its symlink is reused for all its particles
+            stagedStacks = getattr(self, '_stagedStacks', {})
+            self._stagedStacks = stagedStacks
+            #Every scratch directory has its own manifest
+            manifests = dict((root, StagingManifest(root)) for root in scratchRoots)
+            #Number of stacks staged with every method (reflink, hardlink, copy, transform)
+            self._stagingCounts = getattr(self, '_stagingCounts', Counter())
+            try:
+                pendingCopies = []
+                for img in imgSet:
+                    filename = img.getFileName()
+                    if filename not in stagedStacks:
+                        stagedStacks[filename] = self._stageStack(filename, manifests, pendingCopies)
+                    img.setFileName(stagedStacks[filename])
+                #The stacks are copied in parallel, to all the scratch directories at the same time
+                with ThreadPoolExecutor(max_workers=COPY_THREADS_PER_ROOT * len(scratchRoots)) as pool:
+                    methods = list(pool.map(lambda copy: self._copyStack(copy[0], copy[1], transform), pendingCopies))
+                for (filename, newFilename, root), method in zip(pendingCopies, methods):
+                    self._stagingCounts[method] += 1
+                    manifests[root].add(filename, newFilename, self._getStagingVariant())
+            finally:
+                for manifest in manifests.values():
+                    manifest.close()
+            self.info("Staged stacks by method: {}".format(
+                ", ".join("%s %d" % item for item in sorted(self._stagingCounts.items())) or "none"))
+        #Downsampled particles get the new pixel size and shifts
+        if transform.box:
+            self._updateSampling(imgSet)
+
+    def _stageStack(self,filename,manifests,pendingCopies):
+        '''Find or choose the scratch copy of a stack and return its symlink.
+        Stacks without a valid copy in any manifest are added to pendingCopies'''
+        variant = self._getStagingVariant()
+        newFilename = None
+        for manifest in manifests.values():
+            newFilename = manifest.find(filename, variant)
+            if newFilename is not None:
+                break
+        if newFilename is None:
+            root = self._getScratchRoot(filename, os.path.getsize(filename))
+            newFilename = self._getScratchFilename(filename, root)
+            #Stacks that are already in the scratch drive are not copied
+            if newFilename != filename:
+                pendingCopies.append((filename, newFilename, root))
+        symlink = self._getExtraPath(filename)
+        if os.path.lexists(symlink) and os.path.realpath(symlink) != os.path.realpath(newFilename):
+            os.remove(symlink)
+        if not os.path.lexists(symlink):
+            self.info("Creating symlink from {} to {}".format(symlink,newFilename))
             pwutils.path.makeFilePath(symlink)
-            if not os.path.exists(newFilename):
-            	self.info("Copying {} to {}".format(filename,newFilename))
-            	pwutils.path.copyFile(filename, newFilename)
+            pwutils.path.createLink(newFilename, symlink)
+        return symlink
+
+    def _copyStack(self,filename,newFilename,transform):
+        '''Copy (or transform) a stack to the scratch drive and return the method used'''
+        #Several threads can create the same folder at the same time
+        os.makedirs(os.path.dirname(newFilename), exist_ok=True)
+        self.info("Copying {} to {}".format(filename,newFilename))
+        if transform.isIdentity():
+            return fastCopyFile(filename, newFilename)
+        transformStack(filename, newFilename, transform)
+        return 'transform'
+
+    def _takeRepackBatch(self,imgSet,streamClosed):
+        '''Keep the new images until there are enough for an output batch, and return them once they are repacked'''
+        pending = getattr(self, '_repackPending', []) + imgSet
+        if len(pending) < self.outputSize.get() and not streamClosed:
+            self._repackPending = pending
+            if imgSet:
+                self.info("{} particles waiting to be repacked".format(len(pending)))
+            return []
+        self._repackPending = []
+        self._moveImages(pending)
+        return pending
+
+    def _repackImages(self,imgSet):
+        if not imgSet:
+            return
+        #Every check writes its own stacks, in the same relative path on the scratch drive and in the extra dir
+        batchName = os.path.join('repacked', datetime.now().strftime('batch_%Y%m%d_%H%M%S_%f'))
+        scratchPath = self._getScratchRoot(batchName, self._getImgSetSize(imgSet))
+        stackPrefix = os.path.join(scratchPath, self._getExtraPath(batchName))
+        pwutils.path.makeFilePath(stackPrefix)
+        locations = [img.getLocation() for img in imgSet]
+        self.info("Repacking {} particles into {}".format(len(locations), stackPrefix))
+        newLocations = repackImages(locations, stackPrefix, REPACKED_STACK_SIZE, self._getStagingTransform())
+        for img, (index, filename), (newIndex, newFilename) in zip(imgSet, locations, newLocations):
+            symlink = self._getExtraPath('repacked', os.path.basename(newFilename))
             if not os.path.exists(symlink):
-            	self.info("Creating symlink from {} to {}".format(symlink,newFilename))
-            	pwutils.path.createLink(newFilename, symlink)
-            img.setFileName(symlink)
+                pwutils.path.makeFilePath(symlink)
+                pwutils.path.createLink(newFilename, symlink)
+            #The original location is kept to revert the particles
+            img._scratchSourceFile = String(filename)
+            img._scratchSourceIndex = Integer(index)
+            img.setLocation(newIndex, symlink)
+
+    def _getStagingTransform(self):
+        return StagingTransform(self.stageBoxSize.get(), self.stageFloat16.get())
+
+    def _getStagingVariant(self):
+        '''Name of the transform applied to the staged stacks, empty for plain copies'''
+        transform = self._getStagingTransform()
+        if transform.isIdentity():
+            return ''
+        return 'staged_box%d%s' % (transform.box, '_float16' if transform.float16 else '')
+
+    def _getScratchRoots(self):
+        return [str(self.scratchPath)] + self.extraScratchPaths.get('').split()
+
+    def _getScratchWeights(self):
+        weights = [float(w) for w in self.scratchWeights.get('').split()]
+        return weights or [1.0] * len(self._getScratchRoots())
+
+    def _getScratchRoot(self,key,size):
+        '''Scratch directory for key (a stack or batch): the first one in its ranking with enough free space'''
+        roots = rankScratchRoots(key, self._getScratchRoots(), self._getScratchWeights())
+        for root in roots:
+            if shutil.disk_usage(root).free > size:
+                return root
+        return roots[0]
+
+    def _getScratchFilename(self,filename,scratchPath):
+        '''Path of the copy of a stack in a scratch directory'''
+        if any(filename.startswith(root) for root in self._getScratchRoots()):
+            return filename
+        #Named after the real path of the stack, so it is never shared by different stacks of other projects
+        return getStagedFilename(filename, scratchPath, self._getStagingVariant())
+
+    def _getStagedSamplingRate(self):
+        inputImages = self.inputImages.get()
+        return inputImages.getSamplingRate() * inputImages.getDimensions()[0] / float(self.stageBoxSize.get())
+
+    def _updateSampling(self,imgSet):
+        samplingRate = self._getStagedSamplingRate()
+        factor = self.inputImages.get().getSamplingRate() / samplingRate
+        for img in imgSet:
+            #The original pixel size is kept to revert the particles
+            img._scratchSourceSampling = Float(img.getSamplingRate())
+            img.setSamplingRate(samplingRate)
+            if img.hasTransform():
+                img.getTransform().scaleShifts(factor)
+
+    def _updateOutputSet(self, outputName, outputSet, state=Set.STREAM_OPEN):
+        #The output sets copy the pixel size of the input, which changes when the particles are downsampled
+        if not self.revert and self.stageBoxSize.get():
+            outputSet.setSamplingRate(self._getStagedSamplingRate())
+        elif self.revert and getattr(self, '_revertedSamplingRate', None):
+            outputSet.setSamplingRate(self._revertedSamplingRate)
+        super()._updateOutputSet(outputName, outputSet, state)
+        #Downstream WARPhole protocols wait for the events instead of polling the set
+        events = getattr(self, '_setEvents', {})
+        self._setEvents = events
+        fileName = outputSet.getFileName()
+        if fileName not in events:
+            events[fileName] = SetEvents(fileName)
+        events[fileName].publish(state == Set.STREAM_CLOSED)
+
+    def _validate(self):
+        errors = []
+        if not self.revert and self.scratchWeights.get(''):
+            try:
+                weights = [float(w) for w in self.scratchWeights.get('').split()]
+            except ValueError:
+                weights = []
+            if len(weights) != len(self._getScratchRoots()) or min(weights) <= 0:
+                errors.append("Give one positive weight for every scratch directory, starting with the main one.")
+        box = self.stageBoxSize.get()
+        if not self.revert and box:
+            dims = self.inputImages.get().getDimensions()
+            if box % 2:
+                errors.append("The box size for downsampling must be even.")
+            elif dims and dims[0] and box >= dims[0]:
+                errors.append("The box size for downsampling must be smaller than the particle box (%d px)." % dims[0])
+        return errors
 
     def _revertImages(self,imgSet):
         for img in imgSet:
-            filename = img.getFileName()
-            newFilename = 'Runs'.join([filename.split("Runs")[0]] + filename.split("Runs")[2:])
-            img.setFileName(newFilename)
+            if hasattr(img, '_scratchSourceFile'):
+                img.setLocation(img._scratchSourceIndex.get(), img._scratchSourceFile.get())
+            else:
+                filename = img.getFileName()
+                newFilename = 'Runs'.join([filename.split("Runs")[0]] + filename.split("Runs")[2:])
+                img.setFileName(newFilename)
+            #Downsampled particles get back their original pixel size and shifts
+            if hasattr(img, '_scratchSourceSampling'):
+                sourceSamplingRate = img._scratchSourceSampling.get()
+                if img.hasTransform():
+                    img.getTransform().scaleShifts(img.getSamplingRate() / sourceSamplingRate)
+                img.setSamplingRate(sourceSamplingRate)
+                self._revertedSamplingRate = sourceSamplingRate
 
     def _getImgSetSize(self,imgSet):
         totalSize = 0
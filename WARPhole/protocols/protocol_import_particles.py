@@ -33,12 +33,14 @@ This protocol can work in streaming mode.
 """
 
 from pyworkflow.protocol import Protocol, params, Integer
+from pyworkflow.object import Set
 from pwem.protocols.protocol_import.images import ProtImportImages
 from pwem.objects import Micrograph, MovieAlignment, Movie, Particle
 from pwem.objects.data import SetOfMicrographs, SetOfParticles, SetOfMovies, SetOfCoordinates, SetOfCTF
 from pyworkflow.utils import Message
 import pyworkflow.utils as pwutils
-from .WARPimporter import WARPimporter
+from .import_utils import ImportSession, CommitPolicy
+from .streaming_utils import ensureIndexes, CREATION_INDEX, SetEvents
 import time
 import os
 from pwem.protocols import EMProtocol
@@ -50,6 +52,9 @@ class WARPholeImportParticles(EMProtocol):
     _label = 'Import WARP particles'
     _outputClassName = 'SetOfParticles'
 
+    OUTPUTS_STREAMING = 0
+    OUTPUTS_DEFERRED = 1
+
     # -------------------------- DEFINE param functions ----------------------
 
     def _defineParams(self, form):
@@ -68,12 +73,66 @@ class WARPholeImportParticles(EMProtocol):
                       default=0,
                       help="The star file is read every these many seconds, and new particles are imported. If no new particles are found, the import is considered to be finished. Set to zero for no streaming.")
 
+        form.addParam('idleTimeout', params.FloatParam,
+                      label='Finish when idle for (sec): ',
+                      default=0,
+                      condition='fileTimeout > 0',
+                      help="The import finishes when the star file has not changed and no new particles were found for these many seconds. "
+                           "If zero, the time between reads of the star file is used.")
+
+        form.addParam('maxFileTimeout', params.FloatParam,
+                      label='Maximum time between reads when idle (sec): ',
+                      default=0,
+                      condition='fileTimeout > 0',
+                      help="While no new particles arrive, the time between reads of the star file doubles after every read, up to this value. "
+                           "This reduces the load on the file server during pauses of the session. If zero, the star file is always read every 'Load new particles after' seconds.")
+
+        line = form.addLine('Write outputs every',
+                            condition='fileTimeout > 0',
+                            help="The new items are written to the output sets when there are at least these many new particles, "
+                                 "or after these many seconds since the last write, whichever happens first. "
+                                 "Fewer and larger writes make the downstream protocols check their inputs less often. "
+                                 "If both are zero, the outputs are written after every read with new particles.")
+        line.addParam('commitRows', params.IntParam, default=0,
+                      validators=[params.GE(0)], label='particles')
+        line.addParam('commitInterval', params.FloatParam, default=0,
+                      validators=[params.GE(0)], label='seconds')
+
         form.addParam('copyBinaries', params.BooleanParam,
                       default=False,
                       label='Copy binary files?',
                       important=False,
                       help="If no, the plugin will create symlinks to the imported binary files. If yes, the binary files will be copied into the scipion directory.")
 
+        form.addParam('sharedCachePath', params.FolderParam,
+                      condition='copyBinaries',
+                      allowsNull=True,
+                      label='Shared binary cache',
+                      important=False,
+                      help="Optional folder shared by several projects. If given, the binary files are copied into it only once, "
+                           "and every project links to the cached copies, so importing the same WARP session again only costs the metadata. "
+                           "Cached files that are not used by any existing protocol anymore are deleted when an import starts. "
+                           "Only the protocols run on the same host are checked, so the projects folder must have the same path for all the imports run on a host.")
+
+        form.addParam('validateStacks', params.BooleanParam,
+                      default=True,
+                      label='Check particle stacks?',
+                      important=False,
+                      help="If yes, the header of every new particle stack is read to check that the stack already contains the particles listed in the star file. Particles of stacks that WARP is still writing are imported in a later iteration.")
+
+        form.addParam('compactParticleCtf', params.BooleanParam,
+                      default=False,
+                      label='Store compact particle CTF?',
+                      important=False,
+                      help="If yes, the particles only store the defocus values and phase shift of their CTF. The full CTF models are still available in the output CTF set. This makes the particle set smaller and faster to write.")
+
+        form.addParam('writeColumnCache', params.BooleanParam,
+                      default=False,
+                      label='Write particle column cache?',
+                      important=False,
+                      help="If yes, the star file rows of the imported particles are also stored as NumPy arrays (one file per column, in chunks) in the particles1_columns folder of this protocol. "
+                           "They can be memory-mapped by other tools without parsing the star file or the particle set again, and avoid importing the same particles twice when the protocol is continued.")
+
         form.addParam('dosePerFrame', params.FloatParam,
                       label='Dose per frame',
                       default=0,
@@ -101,6 +160,32 @@ class WARPholeImportParticles(EMProtocol):
                       default=72000,
                       help="After the particle import is finished, what these many seconds for the movie motion correction star files to be available. Set to zero if the files are already available.")
 
+        group = form.addGroup('Outputs')
+        group.addParam('importMicrographs', params.BooleanParam,
+                       default=True,
+                       label='Output micrographs?')
+        group.addParam('importCtf', params.BooleanParam,
+                       default=True,
+                       label='Output CTFs?')
+        group.addParam('importCoordinates', params.BooleanParam,
+                       default=True,
+                       label='Output coordinates?',
+                       help="Coordinates also need the micrographs output.")
+        group.addParam('importMovies', params.BooleanParam,
+                       default=True,
+                       label='Output movies?')
+        group.addParam('auxiliaryOutputs', params.EnumParam,
+                       choices=['Update in streaming', 'Create when the import finishes'],
+                       default=self.OUTPUTS_STREAMING,
+                       label='Micrographs, CTFs, coordinates and movies',
+                       display=params.EnumParam.DISPLAY_COMBO,
+                       help="_Update in streaming_: these outputs grow together with the particles.\n"
+                            "_Create when the import finishes_: only the particles are an output while importing. "
+                            "The micrographs, CTFs and movies are written to their own files together with the particles, "
+                            "and the coordinates are taken from the imported particles once the import is finished, when all of them become outputs. "
+                            "If the protocol is stopped, continue it to get these outputs. "
+                            "Use this if the downstream protocols only need the particles.")
+
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         #Create empty sets of particles, coordinates, micrographs, ctfs and movies.
@@ -117,20 +202,11 @@ class WARPholeImportParticles(EMProtocol):
         self.importFilePath = self.starFile.get('').strip()
         #Creating an empty data sets
         self.outputParticles1 = SetOfParticles(filename=self._getPath("particles1.sqlite"))
-        self.outputMicrographs1 = SetOfMicrographs(filename=self._getPath("micrographs1.sqlite"))
-        self.outputCoordinates1 = SetOfCoordinates(filename=self._getPath("coordinates1.sqlite"))
-        self.outputMovies1 = SetOfMovies(filename=self._getPath("movies1.sqlite"))
-        self.outputCoordinates1.setMicrographs(self.outputMicrographs1)
-        self.outputCtf1 = SetOfCTF(filename=self._getPath("ctf1.sqlite"))
-        #Define outputs
+        self._createAuxiliarySets()
+        #Define outputs. In deferred mode, only the particles are defined now.
         self._defineOutputs(outputParticles1 = self.outputParticles1)
-        self._defineOutputs(outputMicrographs1 = self.outputMicrographs1)
-        self._defineOutputs(outputCoordinates1 = self.outputCoordinates1)
-        self._defineOutputs(outputCtf1 = self.outputCtf1)
-        self._defineOutputs(outputMovies1 = self.outputMovies1)
-        self._defineCtfRelation(self.outputMicrographs1, self.outputCtf1)
-        self._defineSourceRelation(self.outputMicrographs1, self.outputCoordinates1)
-        self._defineSourceRelation(self.outputMicrographs1, self.outputParticles1)
+        if self.auxiliaryOutputs.get() == self.OUTPUTS_STREAMING:
+            self._defineAuxiliaryOutputs()
         #If movie alignments are imported, we create new, separate output datasets.
         #This is necessary in case not all movie alignments can be imported.
         #In this case, these incomplete datasets will be exposed to the user.
@@ -146,25 +222,41 @@ class WARPholeImportParticles(EMProtocol):
 
     def importParticleStep(self, *args):
         '''This function creates a WARPimporter object to read the goodparticles star file'''
-        #The import file modification time is used to decide when the import is finished.
-        #In case the import file is in a different server, there might be a difference in the
-        #sytem time, so using the time difference is safer.
-        timeDifference = time.time() - self.mtime(self.importFilePath)
+        #The importer needs the relion plugin, which is only loaded when the protocol runs
+        from .WARPimporter import WARPimporter
+        #The session is followed to decide when to read the star file again and when the import is finished
+        session = ImportSession(self.fileTimeout.get(), self._getIdleTimeout(), self.maxFileTimeout.get())
+        #The output sets are only written when enough particles or time have accumulated
+        commitPolicy = CommitPolicy(self.commitRows.get(), self.commitInterval.get())
+        particlesIndexed = False
         #Create a WARP importer object with the data sets (created in prepareImporterStep())
         #Tthat will be populated by the importer
-        importer = WARPimporter(self, self.starFile.get(),self.outputParticles1,self.outputMicrographs1,self.outputCoordinates1, self.outputMovies1, self.outputCtf1)
+        deferred = self.auxiliaryOutputs.get() == self.OUTPUTS_DEFERRED
+        #The deferred sets are not outputs yet, so a continued protocol opens them again from their files
+        if deferred and not all(hasattr(self, outputName) for outputName in self._getAuxiliaryOutputs()):
+            self._createAuxiliarySets()
+        importer = WARPimporter(self, self.starFile.get(),self.outputParticles1,self._getOutputSet('outputMicrographs1'),self._getOutputSet('outputCoordinates1'), self._getOutputSet('outputMovies1'), self._getOutputSet('outputCtf1'), deferAuxiliary=deferred, sidecarPath=self._getColumnCachePath())
         #Start the loop
         finish = False
+        pendingStart = None
         while not finish:
             #Import new particles
-            importer.importParticles()
+            newParticles = importer.importParticles()
+            session.update(len(newParticles), self.mtime(self.importFilePath))
 
             #Update the output sets
-            self._updateOutputSet("outputMicrographs1",self.outputMicrographs1,self.outputMicrographs1.STREAM_OPEN)
-            self._updateOutputSet("outputParticles1",self.outputParticles1,self.outputParticles1.STREAM_OPEN)
-            self._updateOutputSet("outputCoordinates1",self.outputCoordinates1,self.outputCoordinates1.STREAM_OPEN)
-            self._updateOutputSet("outputCtf1",self.outputCtf1,self.outputCtf1.STREAM_OPEN)
-            self._updateOutputSet("outputMovies1",self.outputMovies1,self.outputMovies1.STREAM_OPEN)
+            commitPolicy.add(len(newParticles))
+            if commitPolicy.isDue():
+                importer.commitSidecar()
+                for outputName in self._getStreamingOutputs():
+                    outputSet = getattr(self, outputName)
+                    self._updateOutputSet(outputName, outputSet, outputSet.STREAM_OPEN)
+                if deferred:
+                    self._writeDeferredSets()
+                commitPolicy.committed()
+                #Downstream protocols (e.g. copy to scratch) query the new particles by creation date
+                if not particlesIndexed:
+                    particlesIndexed = ensureIndexes(self.outputParticles1.getFileName(), CREATION_INDEX)
 
             #Update the summary info for the user
             summary = "Import from {} file:\n".format(self.importFilePath)
@@ -182,30 +274,48 @@ class WARPholeImportParticles(EMProtocol):
             if self.hasAttribute('outputMicrographs1'):
                 summary += '   Micrographs: *%d* \n' % (self.outputMicrographs1.getSize())
 
+            if session.rate.rate is not None:
+                summary += '   Arrival rate: *%0.1f* particles/min\n' % (session.rate.rate * 60)
+
             self.summaryVar.set(summary)
 
-            #If the import file has not been modified after some time time, stop importing. Else sleep and do another interation
-            if time.time() - self.mtime(self.importFilePath) > timeDifference + self.fileTimeout.get():
-                #Break the loop
-                self.warning("Star file was not updated in", time.time() - self.mtime(self.importFilePath))
+            #If the session has been idle for too long, stop importing. Else wait and do another iteration.
+            #The wait never goes past the idle timeout, so the last iteration reads the file right before finishing
+            #Particles that could not be imported yet (e.g. of incomplete stacks) are retried for at most one more idle timeout
+            if session.isFinished():
+                pendingRows = importer.countPendingRows()
+                if pendingStart is None:
+                    pendingStart = time.time()
+                if pendingRows and time.time() - pendingStart < self._getIdleTimeout():
+                    self.info("Waiting for {} particles that could not be imported yet (e.g. of incomplete stacks) before finishing".format(pendingRows))
+                    time.sleep(max(self.fileTimeout.get(), 1))
+                    continue
+                if pendingRows:
+                    self.warning("{} particles could not be imported (e.g. their stacks are incomplete) and were dropped".format(pendingRows))
+                self.warning("No new particles or changes in the star file for {:0.0f} seconds, finishing the import".format(session.idleTime()))
                 finish = True
             else:
-                time.sleep(self.fileTimeout.get())
-            #First we update and close the streaming of the datasets
+                pendingStart = None
+                time.sleep(session.nextInterval())
 
         #Before we finish this step, we update and cloaseall the data sets
-        self.warning("Closing set of " + str(self.outputMicrographs1.getSize()) + "micrographs")
-        self._updateOutputSet("outputMicrographs1",self.outputMicrographs1,self.outputMicrographs1.STREAM_CLOSED)
-        self.warning("Closing set of " + str(self.outputParticles1.getSize()) + "particles")
-        self._updateOutputSet("outputParticles1",self.outputParticles1,self.outputParticles1.STREAM_CLOSED)
-        self.warning("Closing set of " + str(self.outputCoordinates1.getSize()) + "coordinates")
-        self._updateOutputSet("outputCoordinates1",self.outputCoordinates1,self.outputCoordinates1.STREAM_CLOSED)
-        self.warning("Closing set of " + str(self.outputCtf1.getSize()) + "CTFS")
-        self._updateOutputSet("outputCtf1",self.outputCtf1,self.outputCtf1.STREAM_CLOSED)
-        self.warning("Closing set of " + str(self.outputMovies1.getSize()) + "movies")
-        self._updateOutputSet("outputMovies1",self.outputMovies1,self.outputMovies1.STREAM_CLOSED)
+        importer.commitSidecar()
+        for outputName in self._getStreamingOutputs():
+            outputSet = getattr(self, outputName)
+            self.warning("Closing set of " + str(outputSet.getSize()) + " items in " + outputName)
+            self._updateOutputSet(outputName, outputSet, outputSet.STREAM_CLOSED)
+
+        #In deferred mode, the rest of the outputs are defined now, and the coordinates are taken from the imported particles
+        if deferred:
+            importer.materializeDeferredSets()
+            self._defineAuxiliaryOutputs()
+            for outputName in self._getAuxiliaryOutputs():
+                outputSet = getattr(self, outputName)
+                self.warning("Closing set of " + str(outputSet.getSize()) + " items in " + outputName)
+                self._updateOutputSet(outputName, outputSet, outputSet.STREAM_CLOSED)
 
     def importAlignedMoviesStep(self):
+        from .WARPimporter import WARPimporter
         #Create the importer object with the data sets that will be populated
         importer = WARPimporter(self, self.importFilePath,self.outputParticles2,self.outputMicrographs2,self.outputCoordinates2,self.outputAlignedMovies1,self.outputCtf2,importAlignments=True)
         #Save the time when we start waiting for the movie alingments to be available
@@ -263,18 +373,96 @@ class WARPholeImportParticles(EMProtocol):
         self._updateOutputSet("outputCtf2",self.outputCtf2,self.outputCtf2.STREAM_CLOSED)
         self._updateOutputSet("outputCoordinates2",self.outputCoordinates2,self.outputCoordinates2.STREAM_CLOSED)
 
+    # --------------------------- UTILS functions -----------------------------------
+    def _createAuxiliarySets(self):
+        '''Create the sets of micrographs, coordinates, movies and CTFs, or open them if their files exist'''
+        if self.importMicrographs.get():
+            self.outputMicrographs1 = SetOfMicrographs(filename=self._getPath("micrographs1.sqlite"))
+        if self.importCoordinates.get():
+            self.outputCoordinates1 = SetOfCoordinates(filename=self._getPath("coordinates1.sqlite"))
+            self.outputCoordinates1.setMicrographs(self.outputMicrographs1)
+        if self.importMovies.get():
+            self.outputMovies1 = SetOfMovies(filename=self._getPath("movies1.sqlite"))
+        if self.importCtf.get():
+            self.outputCtf1 = SetOfCTF(filename=self._getPath("ctf1.sqlite"))
+
+    def _writeDeferredSets(self):
+        '''Commit the sets that are not outputs yet to their files, so they are kept if the protocol is stopped'''
+        for outputName in self._getAuxiliaryOutputs():
+            if outputName != 'outputCoordinates1':
+                getattr(self, outputName).write()
+
+    def _getAuxiliaryOutputs(self):
+        '''Names of the selected outputs, other than the particles'''
+        outputs = []
+        if self.importMicrographs.get():
+            outputs.append('outputMicrographs1')
+        if self.importCoordinates.get():
+            outputs.append('outputCoordinates1')
+        if self.importCtf.get():
+            outputs.append('outputCtf1')
+        if self.importMovies.get():
+            outputs.append('outputMovies1')
+        return outputs
+
+    def _getStreamingOutputs(self):
+        '''Names of the outputs that are updated at every iteration of the import'''
+        if self.auxiliaryOutputs.get() == self.OUTPUTS_DEFERRED:
+            return ['outputParticles1']
+        return ['outputParticles1'] + self._getAuxiliaryOutputs()
+
+    def _getOutputSet(self, outputName):
+        return getattr(self, outputName, None)
+
+    def _updateOutputSet(self, outputName, outputSet, state=Set.STREAM_OPEN):
+        super()._updateOutputSet(outputName, outputSet, state)
+        #Downstream WARPhole protocols wait for the events instead of polling the set
+        self._publishSetEvent(outputSet, state == Set.STREAM_CLOSED)
+
+    def _publishSetEvent(self, outputSet, closed):
+        events = getattr(self, '_setEvents', {})
+        self._setEvents = events
+        fileName = outputSet.getFileName()
+        if fileName not in events:
+            events[fileName] = SetEvents(fileName)
+        events[fileName].publish(closed)
+
+    def _getIdleTimeout(self):
+        return self.idleTimeout.get() or self.fileTimeout.get()
+
+    def _getColumnCachePath(self):
+        return self._getPath('particles1_columns') if self.writeColumnCache.get() else None
+
+    def _defineAuxiliaryOutputs(self):
+        for outputName in self._getAuxiliaryOutputs():
+            self._defineOutputs(**{outputName: getattr(self, outputName)})
+        if self.importMicrographs.get():
+            if self.importCtf.get():
+                self._defineCtfRelation(self.outputMicrographs1, self.outputCtf1)
+            if self.importCoordinates.get():
+                self._defineSourceRelation(self.outputMicrographs1, self.outputCoordinates1)
+            self._defineSourceRelation(self.outputMicrographs1, self.outputParticles1)
+
     # --------------------------- INFO functions -----------------------------------
     #Get the modification time of the input star file. Sometimes, this can fail if the file is
-    #being updated by WARP, so we catch that exception and try again later
+    #being updated by WARP, so we catch that exception, return None and try again later
     def mtime(self,f):
         try:
             mtime = os.path.getmtime(f)
-        except Exception as e:
-            mtime = time.time()
-            print(e)
-            print("Star file seems to be busy. Waiting...")
+        except OSError as e:
+            mtime = None
+            self.warning("Star file seems to be busy ({}). Waiting...".format(e))
         return(mtime)
 
+    def _validate(self):
+        errors = []
+        if not self.importMicrographs.get():
+            if self.importCoordinates.get():
+                errors.append("The coordinates output needs the micrographs output.")
+            if self.doImportAlignedMovies.get():
+                errors.append("Importing aligned movies needs the micrographs output.")
+        return errors
+
     def _summary(self):
         return [self.summaryVar.get('')]
 
@@ -25,31 +25,31 @@
 # *
 # **************************************************************************
 
-import time
-
-import pyworkflow.object as pwobj
 import pyworkflow.protocol.params as params
-from pyworkflow.project import Manager
 
 from emfacilities.protocols.protocol_monitor import ProtMonitor
 
+from .streaming_utils import CumulativeStreamerMixin
+
 '''
 This protocol is a modified version of the emfaicilites 2D streamer protocol
 to run 3D classifications.
 There is a new option to output particle batches cumulatively, that is,
 every new batch also contains the previous batches.
 '''
-class ProtMonitor3dStreamerCumulative(ProtMonitor):
+class ProtMonitor3dStreamerCumulative(CumulativeStreamerMixin, ProtMonitor):
     """ This protocol will monitor an input set of particles
     (usually in streaming) and will run/schedule many copies
      of a given 3D classification protocol but using subsets
      of the input particles as the 3D classification input.
     """
     _label = '3d streamer'
+    _templateParamName = 'input3dProtocol'
+    _classificationLabel = '3D'
 
     def __init__(self, **kwargs):
         ProtMonitor.__init__(self, **kwargs)
-        self._runIds = pwobj.CsvList(pType=int)
+        self._initCursor()
 
     def _defineParams(self, form):
         form.addSection(label='Input')
@@ -70,11 +70,7 @@ class ProtMonitor3dStreamerCumulative(ProtMonitor):
                            'many 3D classification runs based on the 3D '
                            'protocol template selected. ')
 
-        form.addParam('batchSize', params.IntParam,
-                      label="Batch size",
-                      help="How many particles (approximately) you want to "
-                           "group to make the new batch and launch a new 3d"
-                           "classification job. ")
+        self._defineBatchParams(form)
 
         form.addParam('startingNumber', params.IntParam, default=0,
                       label="Starting number",
@@ -89,111 +85,10 @@ class ProtMonitor3dStreamerCumulative(ProtMonitor):
                               important=False,
                               help="If yes, new batches will also contain the particles in the previous batches. If no, only the last batch size particles are exported.")
 
+        self._defineSamplingParams(form)
 
-        group = form.addGroup('Monitoring')
-        group.addParam('samplingInterval', params.IntParam, default=10,
-                       label="Update interval (min)",
-                       help="After how many minutes the protocol should look "
-                            "for new input data and schedule more 3D classification"
-                            "jobs if necessary. ")
+        self._defineMonitoringParams(form)
 
     # --------------------------- INSERT steps functions ---------------------
     def _insertAllSteps(self):
         self._insertFunctionStep('monitorStep')
-
-    # --------------------------- STEPS functions ----------------------------
-    def monitorStep(self):
-        interval = self.samplingInterval.get() * 60
-        # list of particles that will be inserted in the new set
-        self._counter = 0
-        self._lastMicId = None
-        self._lastPartId = self.startingNumber.get()
-        self._subset = self._createSubset()
-        self._runPrerequisites = []
-        if self.input3dProtocol.get().isActive():
-            self._runPrerequisites.append(self.input3dProtocol.get().getObjId())
-        self._streamClosed = False
-        # list of runs that has been (or will) be scheduled/run
-
-        finished = False
-
-        while not finished:
-            self._checkNewInput()
-            time.sleep(interval)
-            finished = self._streamClosed
-
-    # -------------------------- UTILS functions ------------------------------
-    def _createSubset(self):
-        """ Create a new empty set of particles with a given suffix. """
-        self._counter += 1
-        subset = self._createSetOfParticles(suffix="_%03d" % self._counter)
-        subset.copyInfo(self.inputParticles.get())
-
-        return subset
-
-    def _writeSubset(self, subset):
-        """ Generated the output of this subset. """
-        newSubsetName = 'outputParticles_%03d' % self._counter
-        self.info("Creating new subset: %s" % newSubsetName)
-        subset.write()
-        self._defineOutputs(**{newSubsetName: subset})
-        self._defineTransformRelation(self.inputParticles, subset)
-        # The following is required to commit the changes to the database
-        self._store(subset)
-        subset.close()
-
-        manager = Manager()
-        project = manager.loadProject(self.getProject().getName())
-        input3D = self.input3dProtocol.get()
-        copyProt = project.copyProtocol(project.getProtocol(input3D.getObjId()))
-        copyProt.inputParticles.set(project.getProtocol(self.getObjId()))
-        copyProt.inputParticles.setExtended(newSubsetName)
-        project.scheduleProtocol(copyProt, self._runPrerequisites)
-        # Next schedule will be after this one
-        self._runPrerequisites.append(copyProt.getObjId())
-
-    def _checkNewInput(self):
-        """ Check if there are new particles and generate a new set
-        and its corresponding 3D classification. """
-        self.info("Checking new input...")
-        subset = self._subset
-
-        for particle in self._iterParticles():
-            micId = particle.getMicId()
-            partId = particle.getObjId()
-            subset.append(particle)
-            #self.info("micId: %03d, particle: %05s, size: %s"
-            #          % (micId, partId, subset.getSize()))
-            self._lastPartId = partId
-            # Check the following after finding particles of a new micrograph
-            if micId != self._lastMicId:
-                batchSize = int(self.batchSize)*self.cumulative.get()*self._counter + int(self.batchSize)*(not self.cumulative.get())
-                self._lastMicId = micId
-                if self._lastMicId is not None and subset.getSize() > batchSize:
-                    print("Subset size:", subset.getSize())
-                    print("Batch size:", batchSize)
-                    self._writeSubset(subset)
-                    subset = self._createSubset()
-                    if self.cumulative.get():
-                        print("Cumulative is set to true, restarting from particle ",self.startingNumber.get())
-                        self._lastPartId = self.startingNumber.get()
-                        break
-
-        # Write last group of particles if input stream is closed
-        if self._streamClosed:
-            self._writeSubset(subset)
-
-        self._subset = subset
-
-    def _iterParticles(self):
-        inputParts = self.inputParticles.get()
-        inputParts.load()
-        inputParts.loadAllProperties()
-        self._streamClosed = inputParts.isStreamClosed()
-
-        for p in inputParts.iterItems(orderBy=['_micId', 'id'],
-                                      direction='ASC',
-                                      where='id > %d' % self._lastPartId):
-            yield p
-
-        inputParts.close()
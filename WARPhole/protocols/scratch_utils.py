@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+"""
+Helpers used by the copy to scratch protocol.
+"""
+
+import fcntl
+import hashlib
+import math
+import os
+import shutil
+import sqlite3
+import struct
+import time
+
+import numpy as np
+
+from .import_utils import MRC_HEADER_SIZE, MRC_MODE_BYTES, readMrcHeader
+
+# NumPy types of the MRC data modes
+MRC_MODE_DTYPES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16,
+                   12: np.float16}
+# Maximum size of the chunks of images transformed together
+TRANSFORM_CHUNK_SIZE = 64 * 1024**2
+# ioctl request to share the data blocks of a file (Btrfs, XFS)
+FICLONE = 0x40049409
+
+
+class MrcStackReader:
+    """ Reads the raw data of single images of an MRC stack. """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        nx, ny, nz, mode, nsymbt = readMrcHeader(fileName)
+        if MRC_MODE_BYTES.get(mode, 0) < 1:
+            raise ValueError("Unsupported MRC mode %s in %s" % (mode, fileName))
+        self.nx, self.ny, self.mode = nx, ny, mode
+        self._dataOffset = MRC_HEADER_SIZE + nsymbt
+        self.imageSize = nx * ny * MRC_MODE_BYTES[mode]
+        self._file = open(fileName, 'rb')
+        self.header = self._file.read(MRC_HEADER_SIZE)
+        # Images can only go to the same stack if these values are equal
+        self.format = (nx, ny, mode, self.header[212])
+
+    def read(self, index, count=1):
+        '''Raw data of count images, starting at the given (1-based) index'''
+        self._file.seek(self._dataOffset + (max(index, 1) - 1) * self.imageSize)
+        data = self._file.read(self.imageSize * count)
+        if len(data) < self.imageSize * count:
+            raise ValueError("Image %d is missing in %s" % (index, self.fileName))
+        return data
+
+    def countImages(self):
+        self._file.seek(0, 2)
+        return (self._file.tell() - self._dataOffset) // self.imageSize
+
+    def close(self):
+        self._file.close()
+
+
+class MrcStackWriter:
+    """ Writes images one after another into a new MRC stack. The header of
+    the first input stack is used, and the number of images is written when
+    the stack is closed, so only one image is in memory at any time.
+    """
+    def __init__(self, fileName, header, format):
+        self.fileName = fileName
+        self.format = format
+        self.count = 0
+        self.size = MRC_HEADER_SIZE
+        self._header = bytearray(header)
+        self._file = open(fileName, 'wb')
+        self._file.write(bytes(MRC_HEADER_SIZE))
+
+    def write(self, data, count=1):
+        '''Append count images and return the (1-based) index of the last one'''
+        self._file.write(data)
+        self.count += count
+        self.size += len(data)
+        return self.count
+
+    def close(self):
+        header = self._header
+        order = '>' if header[212] == 0x11 else '<'
+        # The size and mode can be changed by a StagingTransform. The cell
+        # lengths are kept, so the pixel size follows the new size
+        nx, ny, mode = self.format[:3]
+        struct.pack_into(order + '4i', header, 0, nx, ny, self.count, mode)
+        struct.pack_into(order + '2i', header, 28, nx, ny)
+        # mz, and the z length of the cell to keep the pixel size
+        struct.pack_into(order + 'i', header, 36, self.count)
+        mx, = struct.unpack_from(order + 'i', header, 28)
+        xlen, = struct.unpack_from(order + 'f', header, 40)
+        if mx:
+            struct.pack_into(order + 'f', header, 48, xlen / mx * self.count)
+        # The extended header is not copied
+        struct.pack_into(order + 'i', header, 92, 0)
+        self._file.seek(0)
+        self._file.write(header)
+        self._file.close()
+
+
+class StagingTransform:
+    """ Converts the images to float16 and/or Fourier-crops them to a
+    smaller box while they are copied to the scratch drive. Cropping in
+    Fourier space keeps the field of view, so the pixel size grows by the
+    same factor the box shrinks.
+    """
+    def __init__(self, box=0, float16=False):
+        self.box = box
+        self.float16 = float16
+
+    def isIdentity(self):
+        return not self.box and not self.float16
+
+    def getFormat(self, reader):
+        '''Format (nx, ny, mode, stamp) of the transformed images of a stack'''
+        if self.isIdentity():
+            return reader.format
+        nx, ny, mode, stamp = reader.format
+        if self.box:
+            nx = ny = self.box
+        return nx, ny, 12 if self.float16 else 2, stamp
+
+    def apply(self, data, reader):
+        '''Transform the raw data of one or more images of the reader stack'''
+        if self.isIdentity():
+            return data
+        order = '>' if reader.format[3] == 0x11 else '<'
+        inType = np.dtype(MRC_MODE_DTYPES[reader.mode]).newbyteorder(order)
+        images = np.frombuffer(data, dtype=inType).reshape(-1, reader.ny, reader.nx)
+        if self.box:
+            images = self._fourierCrop(images)
+        outType = np.dtype(np.float16 if self.float16 else np.float32)
+        return images.astype(outType.newbyteorder(order)).tobytes()
+
+    def _fourierCrop(self, images):
+        n, ny, nx = images.shape
+        half = self.box // 2
+        ft = np.fft.rfft2(images.astype(np.float32))
+        # Keep the lowest frequencies: the first and last rows and the first columns
+        ft = np.concatenate([ft[:, :half, :half + 1],
+                             ft[:, ny - half:, :half + 1]], axis=1)
+        # The scale keeps the mean value of the images
+        return np.fft.irfft2(ft, s=(self.box, self.box)) * (self.box ** 2 / float(nx * ny))
+
+
+def transformStack(source, destination, transform):
+    """ Write a transformed copy of a whole stack. The images are read and
+    transformed in chunks of at most TRANSFORM_CHUNK_SIZE bytes.
+    """
+    reader = MrcStackReader(source)
+    writer = MrcStackWriter(destination, reader.header,
+                            transform.getFormat(reader))
+    try:
+        total = reader.countImages()
+        chunk = max(TRANSFORM_CHUNK_SIZE // reader.imageSize, 1)
+        for first in range(1, total + 1, chunk):
+            count = min(chunk, total - first + 1)
+            writer.write(transform.apply(reader.read(first, count), reader), count)
+    finally:
+        reader.close()
+        writer.close()
+
+
+def repackImages(locations, stackPrefix, maxStackSize, transform=None):
+    """ Copy the images at the given (index, fileName) locations into a few
+    new stacks named stackPrefix_NNN.mrcs, and return the new location of
+    every image, in the same order. The images are read sorted by file and
+    index, so every input stack is read once and sequentially, and a new
+    stack is started when the current one would grow over maxStackSize bytes
+    or the image size or type changes. If a StagingTransform is given, it
+    is applied to every image.
+    """
+    transform = transform or StagingTransform()
+    newLocations = [None] * len(locations)
+    order = sorted(range(len(locations)),
+                   key=lambda i: (locations[i][1], locations[i][0]))
+    reader, writer, stacks = None, None, 0
+    try:
+        for i in order:
+            index, fileName = locations[i]
+            if reader is None or reader.fileName != fileName:
+                if reader is not None:
+                    reader.close()
+                reader = MrcStackReader(fileName)
+            data = transform.apply(reader.read(index), reader)
+            format = transform.getFormat(reader)
+            if (writer is None or writer.format != format or
+                    writer.size + len(data) > maxStackSize):
+                if writer is not None:
+                    writer.close()
+                stacks += 1
+                writer = MrcStackWriter('%s_%03d.mrcs' % (stackPrefix, stacks),
+                                        reader.header, format)
+            newLocations[i] = (writer.write(data), writer.fileName)
+    finally:
+        if reader is not None:
+            reader.close()
+        if writer is not None:
+            writer.close()
+    return newLocations
+
+
+def fastCopyFile(source, target):
+    """ Copy source into target and return the method that was used. When
+    both are in the same file system, the target shares the data of the
+    source: with a reflink if the file system supports it ('reflink'), or
+    else with a hard link ('hardlink'). Otherwise the bytes are copied
+    ('copy').
+    """
+    source = os.path.realpath(source)
+    if os.path.lexists(target):
+        os.remove(target)
+    if os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(target))).st_dev:
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return 'reflink'
+        except OSError:
+            os.remove(target)
+        try:
+            os.link(source, target)
+            return 'hardlink'
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+    return 'copy'
+
+
+def getStagedFilename(source, scratchPath, variant=''):
+    """ Path of the copy of the stack source in a scratch directory. It is
+    named after the real path of the source and the variant, so protocols of
+    different projects never write different stacks to the same target.
+    """
+    source = os.path.realpath(source)
+    key = hashlib.sha1((source + '\0' + variant).encode()).hexdigest()
+    return os.path.join(scratchPath, variant or 'stacks', key[:2], key,
+                        os.path.basename(source))
+
+
+def rankScratchRoots(key, roots, weights):
+    """ Order the scratch roots for the item key (e.g. the path of a stack)
+    by weighted rendezvous hashing. Every key gets a stable order, and the
+    share of keys that go first to every root follows its weight, so the
+    same stack always lands on the same root.
+    """
+    def score(root, weight):
+        digest = hashlib.md5((root + '\0' + key).encode()).hexdigest()
+        uniform = (int(digest[:13], 16) + 1) / float(16 ** 13 + 1)
+        return -weight / math.log(uniform)
+    ranked = sorted(zip(roots, weights), key=lambda rw: score(*rw), reverse=True)
+    return [root for root, _ in ranked]
+
+
+def quickChecksum(fileName, blockSize=1024**2):
+    """ Checksum of the size and the first and last blockSize bytes of a
+    file. It is enough to tell apart different stacks without reading them.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    size = os.path.getsize(fileName)
+    digest.update(str(size).encode())
+    with open(fileName, 'rb') as f:
+        digest.update(f.read(blockSize))
+        if size > blockSize:
+            f.seek(max(size - blockSize, blockSize))
+            digest.update(f.read(blockSize))
+    return digest.hexdigest()
+
+
+class StagingManifest:
+    """ Small sqlite database in the scratch directory with the stacks that
+    were copied to it, shared by all the protocols (and projects) that use
+    the same scratch directory. Sources are stored by their real path, so a
+    stack staged by any protocol is found by all the others. An entry is
+    stale when the size of the source changed, or when its modification
+    time changed and the checksum does not match anymore.
+    """
+    FILE_NAME = 'staging_manifest.sqlite'
+
+    def __init__(self, scratchPath):
+        self.fileName = os.path.join(scratchPath, self.FILE_NAME)
+        self._conn = sqlite3.connect(self.fileName, timeout=60)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS staged "
+                               "(source TEXT, variant TEXT, target TEXT, "
+                               "size INTEGER, mtime REAL, checksum TEXT, "
+                               "stagedTime REAL, PRIMARY KEY (source, variant))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS staged_target "
+                               "ON staged (target)")
+
+    def find(self, source, variant=''):
+        '''Return the staged copy of source, or None if there is no valid one'''
+        source = os.path.realpath(source)
+        row = self._conn.execute("SELECT target, size, mtime, checksum FROM staged "
+                                 "WHERE source=? AND variant=?",
+                                 (source, variant)).fetchone()
+        if row is None:
+            return None
+        target, size, mtime, checksum = row
+        st = os.stat(source)
+        if st.st_size != size or not os.path.exists(target):
+            return None
+        if st.st_mtime != mtime:
+            if quickChecksum(source) != checksum:
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE staged SET mtime=? WHERE source=? "
+                                   "AND variant=?", (st.st_mtime, source, variant))
+        return target
+
+    def add(self, source, target, variant=''):
+        '''Register that source was staged into target'''
+        source = os.path.realpath(source)
+        target = os.path.abspath(target)
+        st = os.stat(source)
+        with self._conn:
+            # The previous content of the target is gone
+            self._conn.execute("DELETE FROM staged WHERE target=?", (target,))
+            self._conn.execute("INSERT OR REPLACE INTO staged VALUES "
+                               "(?, ?, ?, ?, ?, ?, ?)",
+                               (source, variant, target, st.st_size, st.st_mtime,
+                                quickChecksum(source), time.time()))
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,771 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+"""
+Helpers shared by the 2D and 3D classification streamers.
+"""
+
+import json
+import os
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pyworkflow.object as pwobj
+import pyworkflow.protocol.params as params
+from pyworkflow.protocol.constants import MODE_RESTART
+from pyworkflow.project import Manager
+
+# Same value as pyworkflow.object.Set.STREAM_CLOSED
+STREAM_CLOSED = 2
+
+# Index for the queries of new items by creation date
+CREATION_INDEX = {'warphole_creation': ['creation']}
+
+
+def ensureIndexes(fileName, indexes):
+    """ Create indexes on the items table of the sqlite file of a set, if
+    they do not exist yet. indexes is a dict with the name of every index
+    and its list of attributes: 'id', 'creation' or attributes of the items
+    (e.g. '_micId'), which are mapped to their columns. Returns False if
+    they cannot be created yet (the set is still empty or locked), so the
+    caller can try again later. The queries work without the indexes.
+    """
+    if not os.path.exists(fileName):
+        return False
+    try:
+        conn = sqlite3.connect(fileName, timeout=5)
+        try:
+            columns = dict(conn.execute("SELECT label_property, column_name "
+                                        "FROM Classes"))
+            columns.update(id='id', creation='creation')
+            with conn:
+                for name, attributes in indexes.items():
+                    conn.execute("CREATE INDEX IF NOT EXISTS %s ON Objects (%s)"
+                                 % (name, ', '.join(columns[a] for a in attributes)))
+        finally:
+            conn.close()
+    except (sqlite3.Error, KeyError):
+        return False
+    return True
+
+
+class ArrivalRate:
+    """ Keeps a smoothed estimate of how many particles per second
+    are being added to a streaming input set. """
+    def __init__(self, smoothing=0.5):
+        self.smoothing = smoothing
+        self.rate = None
+        self._lastSize = None
+        self._lastTime = None
+
+    def update(self, size, now=None):
+        '''Register the current size of the input set and return the new rate'''
+        now = time.time() if now is None else now
+        if self._lastSize is not None and now > self._lastTime:
+            rate = max(size - self._lastSize, 0) / (now - self._lastTime)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = self.smoothing * rate + (1 - self.smoothing) * self.rate
+        self._lastSize = size
+        self._lastTime = now
+        return self.rate
+
+
+def adaptiveBatchSize(rate, interval, pendingRuns, minSize, maxSize,
+                      parallelRuns=1):
+    """ Number of new particles that should go into the next batch.
+    While there is a free slot for a classification, a batch is emitted with
+    whatever arrived during one interval (but at least minSize), so the first
+    classes come out early. Every run beyond the parallelRuns that can run
+    at the same time makes the next batch bigger, so fewer and larger jobs
+    are queued when the GPUs are busy.
+    """
+    size = minSize
+    if rate:
+        size = max(size, int(rate * interval))
+    size *= 1 + max(pendingRuns - parallelRuns + 1, 0)
+    return int(min(max(size, minSize), maxSize))
+
+
+class MicrographReservoir:
+    """ Keeps at most maxPerMic randomly chosen items of every micrograph,
+    using reservoir sampling so that the choice can be updated as new
+    items arrive. Batches taken from it are spread over all the
+    micrographs seen so far instead of a few consecutive ones.
+    """
+    def __init__(self, maxPerMic, seed=None):
+        self.maxPerMic = maxPerMic
+        self._rng = random.Random(seed)
+        self._items = OrderedDict()
+        self._seen = {}
+        self._size = 0
+
+    def add(self, micId, item):
+        seen = self._seen.get(micId, 0) + 1
+        self._seen[micId] = seen
+        items = self._items.setdefault(micId, [])
+        if len(items) < self.maxPerMic:
+            items.append(item)
+            self._size += 1
+        else:
+            # Replace a kept item with probability maxPerMic / seen
+            j = self._rng.randrange(seen)
+            if j < self.maxPerMic:
+                items[j] = item
+
+    def clear(self):
+        self._items.clear()
+        self._seen.clear()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for items in self._items.values():
+            for item in items:
+                yield item
+
+
+class SetEvents:
+    """ Append-only file next to the sqlite file of a set. The WARPhole
+    protocols that produce a set write one JSON line every time they commit
+    new items to it, with the id of the last item and whether the stream is
+    closed. Consumers can wait for new items by reading the new lines of
+    this file, without querying the set. Sets without this file (from other
+    producers) have to be polled.
+    """
+    SUFFIX = '.events'
+
+    def __init__(self, setFileName):
+        self.setFileName = setFileName
+        self.fileName = setFileName + self.SUFFIX
+        self._offset = 0
+        self.lastId = 0
+        self.closed = False
+
+    def exists(self):
+        return os.path.exists(self.fileName)
+
+    def read(self):
+        '''Read the events written since the last call and return how many there were'''
+        try:
+            with open(self.fileName, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except OSError:
+            return 0
+        # A line that is still being written is read in the next call
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        events = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+        for event in events:
+            self.lastId = max(self.lastId, event['lastId'])
+            self.closed = event['closed']
+        return len(events)
+
+    def publish(self, closed=False):
+        '''Announce the items committed to the set since the last event'''
+        self.read()
+        try:
+            conn = sqlite3.connect('file:%s?mode=ro' % self.setFileName, uri=True,
+                                   timeout=5)
+            try:
+                lastId = conn.execute("SELECT MAX(id) FROM Objects").fetchone()[0] or 0
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return
+        event = OrderedDict([('time', time.time()), ('lastId', lastId),
+                             ('newItems', max(lastId - self.lastId, 0)),
+                             ('closed', closed)])
+        with open(self.fileName, 'a') as f:
+            f.write(json.dumps(event) + '\n')
+        self._offset = os.path.getsize(self.fileName)
+        self.lastId = lastId
+        self.closed = closed
+
+
+class InputProbe:
+    """ Cheap checks on the sqlite file of a streaming set, used to decide
+    when it is worth loading the set again. Only the file modification time
+    and a row count are read, without going through the set mapper.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._lastMtime = None
+        self._events = SetEvents(fileName)
+
+    def _getMtime(self):
+        try:
+            return os.path.getmtime(self.fileName)
+        except OSError:
+            return None
+
+    def hasChanged(self):
+        '''Return True if the file was modified since the last call'''
+        mtime = self._getMtime()
+        changed = mtime is not None and mtime != self._lastMtime
+        self._lastMtime = mtime
+        return changed
+
+    def _query(self, sql, args=()):
+        conn = sqlite3.connect('file:%s?mode=ro' % self.fileName, uri=True,
+                               timeout=5)
+        try:
+            return conn.execute(sql, args).fetchone()
+        finally:
+            conn.close()
+
+    def countNewItems(self, lastId):
+        '''Number of items with an id bigger than lastId'''
+        try:
+            row = self._query("SELECT COUNT(*) FROM Objects WHERE id > ?",
+                              (lastId,))
+        except sqlite3.Error:
+            return 0
+        return row[0] if row else 0
+
+    def isStreamClosed(self):
+        try:
+            row = self._query("SELECT value FROM Properties "
+                              "WHERE key='_streamState'")
+        except sqlite3.Error:
+            return False
+        return row is not None and str(row[0]) == str(STREAM_CLOSED)
+
+    def waitForItems(self, lastId, minItems, timeout, probeInterval):
+        """ Sleep until at least minItems new items are in the set, the
+        stream is closed or timeout seconds have passed, whichever is first.
+        After a first query, the file is only queried again when its
+        modification time changes. If the producer of the set writes
+        SetEvents, only the event file is read.
+        """
+        deadline = time.time() + timeout
+        if self._events.exists():
+            return self._waitForEvents(lastId, minItems, deadline, probeInterval)
+        firstProbe = True
+        while True:
+            changed = self.hasChanged() or firstProbe
+            firstProbe = False
+            if changed and (self.isStreamClosed() or
+                            self.countNewItems(lastId) >= minItems):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(probeInterval, remaining))
+
+    def _waitForEvents(self, lastId, minItems, deadline, probeInterval):
+        '''Same as waitForItems, using the events of the producer of the set'''
+        while True:
+            self._events.read()
+            if (self._events.closed or
+                    self._events.lastId - lastId >= minItems):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(probeInterval, remaining))
+
+
+class StreamerMetrics:
+    """ Counters and timings of the checks done by a streamer. The values
+    of every check are appended as one JSON line to a file, which can be
+    used to tune the batch size and the scheduling options.
+    """
+    CREATION_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, fileName, batchedId=0):
+        self.fileName = fileName
+        # Creation date of the oldest particle that is not in a batch yet,
+        # and highest particle id included in a written batch
+        self._firstArrival = None
+        self._batchedId = batchedId
+        self.reset()
+
+    def reset(self):
+        self._start = time.time()
+        self._maxId = self._batchedId
+        self.values = OrderedDict([
+            ('time', datetime.now().strftime(self.CREATION_FORMAT)),
+            ('scanned', 0),
+            ('scanTime', 0.),
+            ('writeTime', 0.),
+            ('scheduleTime', 0.),
+            ('batches', 0),
+            ('batchLatency', []),
+            ('pendingRuns', 0)])
+
+    def add(self, key, value):
+        self.values[key] += value
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def particleScanned(self, partId, creation):
+        '''Register a particle read from the input set'''
+        self.values['scanned'] += 1
+        if partId > self._batchedId:
+            self._maxId = max(self._maxId, partId)
+            # The dates are stored as text that sorts chronologically
+            if creation and (self._firstArrival is None or
+                             creation < self._firstArrival):
+                self._firstArrival = creation
+
+    def batchWritten(self):
+        '''Register a new batch and how long its oldest new particle waited'''
+        self.values['batches'] += 1
+        if self._firstArrival is not None:
+            arrival = datetime.strptime(str(self._firstArrival)[:19],
+                                        self.CREATION_FORMAT)
+            # Set items store their creation date in UTC
+            latency = (datetime.utcnow() - arrival).total_seconds()
+            self.values['batchLatency'].append(round(latency, 1))
+        self._firstArrival = None
+        self._batchedId = self._maxId
+
+    def write(self):
+        '''Append the values of the current check to the metrics file'''
+        elapsed = time.time() - self._start
+        self.values['scanTime'] = max(elapsed - self.values['writeTime'] -
+                                      self.values['scheduleTime'], 0.)
+        for key in ['scanTime', 'writeTime', 'scheduleTime']:
+            self.values[key] = round(self.values[key], 3)
+        with open(self.fileName, 'a') as f:
+            f.write(json.dumps(self.values) + '\n')
+        return self.values
+
+    @staticmethod
+    def readLast(fileName):
+        '''Return the values of the last check stored in fileName, if any'''
+        if not os.path.exists(fileName):
+            return None
+        last = None
+        with open(fileName) as f:
+            for line in f:
+                if line.strip():
+                    last = line
+        return json.loads(last, object_pairs_hook=OrderedDict) if last else None
+
+
+class CumulativeStreamerMixin:
+    """ Monitoring loop, form parameters and helpers shared by the 2D and 3D
+    cumulative streamers: batch size policy, balanced sampling, input
+    probing, parallel scheduling, the cursor stored to resume a continued
+    monitor and the metrics of every check. The subclasses define the
+    template protocol parameter, whose name is given in _templateParamName,
+    and the kind of classification it runs.
+    """
+    # Name of the pointer parameter to the template protocol
+    _templateParamName = None
+    # Kind of classification run by the template, used in the help texts
+    _classificationLabel = ''
+
+    BATCH_FIXED = 0
+    BATCH_ADAPTIVE = 1
+
+    SAMPLING_ORDERED = 0
+    SAMPLING_BALANCED = 1
+
+    def _initCursor(self):
+        self._runIds = pwobj.CsvList(pType=int)
+        # Position in the input set after the last written batch. It is
+        # stored in the protocol database so that a monitor that is
+        # continued after a stop or a crash resumes from there.
+        self._cursorPartId = pwobj.Integer()
+        self._cursorMicId = pwobj.Integer()
+        self._cursorBatches = pwobj.Integer(0)
+        self._cursorBatchSize = pwobj.Integer(0)
+
+    def _getTemplateProtocol(self):
+        return getattr(self, self._templateParamName).get()
+
+    # --------------------------- DEFINE param functions --------------------
+    def _defineBatchParams(self, form):
+        form.addParam('batchPolicy', params.EnumParam,
+                      choices=['Fixed', 'Adaptive'],
+                      default=self.BATCH_FIXED,
+                      label="Batch size policy",
+                      display=params.EnumParam.DISPLAY_COMBO,
+                      help="_Fixed_: every batch has (approximately) the "
+                           "given batch size.\n"
+                           "_Adaptive_: the batch size is computed at every "
+                           "check from the particle arrival rate and the "
+                           "number of classification jobs that are still "
+                           "waiting or running. Small batches are launched "
+                           "while there are free parallel runs, and bigger "
+                           "ones when the queue is busy.")
+
+        form.addParam('batchSize', params.IntParam,
+                      condition='batchPolicy==%d' % self.BATCH_FIXED,
+                      label="Batch size",
+                      help="How many particles (approximately) you want to "
+                           "group to make the new batch and launch a new %s "
+                           "classification job. " % self._classificationLabel)
+
+        line = form.addLine('Batch size limits',
+                            condition='batchPolicy==%d' % self.BATCH_ADAPTIVE,
+                            help="Minimum and maximum number of new particles "
+                                 "in a batch when the adaptive policy is used.")
+        line.addParam('minBatchSize', params.IntParam, default=5000,
+                      label='Min')
+        line.addParam('maxBatchSize', params.IntParam, default=50000,
+                      label='Max')
+
+    def _defineSamplingParams(self, form):
+        form.addParam('samplingMode', params.EnumParam,
+                      choices=['Micrograph order', 'Balanced over micrographs'],
+                      default=self.SAMPLING_ORDERED,
+                      label="Batch sampling",
+                      display=params.EnumParam.DISPLAY_COMBO,
+                      help="_Micrograph order_: batches are made of all the "
+                           "particles of consecutive micrographs.\n"
+                           "_Balanced over micrographs_: at most a given "
+                           "number of randomly chosen particles is kept for "
+                           "every micrograph, and batches are made from "
+                           "these, so every batch is spread over all the "
+                           "micrographs seen so far. The rest of the "
+                           "particles are not used in the batches.")
+
+        line = form.addLine('Balanced sampling',
+                            condition='samplingMode==%d' % self.SAMPLING_BALANCED,
+                            help="Maximum number of particles kept per "
+                                 "micrograph, and seed of the random "
+                                 "generator used to choose them.")
+        line.addParam('maxPartsPerMic', params.IntParam, default=20,
+                      label='Particles per micrograph')
+        line.addParam('randomSeed', params.IntParam, default=0,
+                      label='Random seed')
+
+    def _defineMonitoringParams(self, form):
+        group = form.addGroup('Monitoring')
+        group.addParam('samplingInterval', params.IntParam, default=10,
+                       label="Update interval (min)",
+                       help="Maximum number of minutes between two checks "
+                            "for new input data to schedule more %s "
+                            "classification jobs if necessary. The input is "
+                            "checked earlier as soon as enough new particles "
+                            "for a batch have arrived or the input stream is "
+                            "closed. " % self._classificationLabel)
+        group.addParam('probeInterval', params.IntParam, default=30,
+                       validators=[params.GE(1)],
+                       label="Input probe interval (sec)",
+                       help="How often the input set file is probed for new "
+                            "particles while waiting. Probing only reads the "
+                            "file modification time and, if it changed, "
+                            "counts the new rows.")
+
+        group = form.addGroup('Scheduling')
+        group.addParam('parallelRuns', params.IntParam, default=1,
+                       validators=[params.GE(1)],
+                       label="Parallel classification runs",
+                       help="How many copies of the template protocol can "
+                            "run at the same time. Batches are distributed "
+                            "over this many chains of scheduled runs, each "
+                            "run waiting only for the previous run of its "
+                            "own chain. Use 1 to run the classifications "
+                            "one after the other.")
+        group.addParam('gpuGroups', params.StringParam, default='',
+                       condition='parallelRuns > 1',
+                       label="GPUs per parallel run",
+                       help="Optional. GPU ids for each chain of runs, "
+                            "separated by '|'. For example, with 4 parallel "
+                            "runs, '0 1 | 2 3 | 4 5 | 6 7' pins every chain "
+                            "to two GPUs. The value is written to the GPU "
+                            "list of the copied protocol, if it has one. "
+                            "Leave empty to keep the GPUs of the template.")
+
+    # --------------------------- STEPS functions ----------------------------
+    def monitorStep(self):
+        interval = self.samplingInterval.get() * 60
+        self._loadCursor()
+        self._reservoir = MicrographReservoir(self.maxPartsPerMic.get(),
+                                              seed=self.randomSeed.get())
+        # list of particles that will be inserted in the new set
+        self._subset = self._createSubset()
+        self._runPrerequisites = []
+        if self._getTemplateProtocol().isActive():
+            self._runPrerequisites.append(self._getTemplateProtocol().getObjId())
+        self._streamClosed = False
+        self._arrivalRate = ArrivalRate()
+        self._inputProbe = InputProbe(self.inputParticles.get().getFileName())
+        self._pendingRuns = 0
+        self._metrics = StreamerMetrics(self._getMetricsFile(),
+                                        batchedId=self._lastPartId)
+        # list of runs that has been (or will) be scheduled/run
+
+        finished = False
+
+        while not finished:
+            self._metrics.reset()
+            self._checkNewInput()
+            self._metrics.write()
+            finished = self._streamClosed
+            if not finished:
+                self._waitForNewInput(interval)
+
+    # -------------------------- UTILS functions ------------------------------
+    def _createSubset(self):
+        """ Create a new empty set of particles with a given suffix. """
+        self._counter += 1
+        subset = self._createSetOfParticles(suffix="_%03d" % self._counter)
+        subset.copyInfo(self.inputParticles.get())
+
+        return subset
+
+    def _writeSubset(self, subset):
+        """ Generated the output of this subset. """
+        newSubsetName = 'outputParticles_%03d' % self._counter
+        self.info("Creating new subset: %s" % newSubsetName)
+        writeStart = time.time()
+        subset.write()
+        self._defineOutputs(**{newSubsetName: subset})
+        self._defineTransformRelation(self.inputParticles, subset)
+        # The following is required to commit the changes to the database
+        self._store(subset)
+        subset.close()
+        self._metrics.add('writeTime', time.time() - writeStart)
+        self._metrics.batchWritten()
+        self._lastBatchSize = subset.getSize()
+
+        # A continued monitor may write again the batch it was writing when
+        # it stopped; do not schedule a second classification for it
+        if self._counter <= len(self._runIds):
+            self.info("%s was already scheduled" % newSubsetName)
+            return
+
+        scheduleStart = time.time()
+        manager = Manager()
+        project = manager.loadProject(self.getProject().getName())
+        template = self._getTemplateProtocol()
+        copyProt = project.copyProtocol(project.getProtocol(template.getObjId()))
+        copyProt.inputParticles.set(project.getProtocol(self.getObjId()))
+        copyProt.inputParticles.setExtended(newSubsetName)
+        # Runs are distributed over parallel chains; each one waits
+        # only for the previous runs of its own chain
+        nChains = self.parallelRuns.get()
+        chain = len(self._runIds) % nChains
+        gpuGroups = self._getGpuGroups()
+        if gpuGroups and copyProt.hasAttribute('gpuList'):
+            copyProt.gpuList.set(gpuGroups[chain % len(gpuGroups)])
+        prerequisites = self._runPrerequisites + self._runIds[chain::nChains]
+        project.scheduleProtocol(copyProt, prerequisites)
+        self._runIds.append(copyProt.getObjId())
+        self._store(self._runIds)
+        self._pendingRuns += 1
+        self._metrics.add('scheduleTime', time.time() - scheduleStart)
+
+    def _checkNewInput(self):
+        """ Check if there are new particles and generate a new set
+        and its corresponding classification. """
+        self.info("Checking new input...")
+        subset = self._subset
+        self._pendingRuns = self._countPendingRuns()
+        self._metrics.set('pendingRuns', self._pendingRuns)
+        if self.samplingMode.get() == self.SAMPLING_BALANCED:
+            self._checkNewInputBalanced()
+            return
+
+        for particle in self._iterParticles():
+            micId = particle.getMicId()
+            partId = particle.getObjId()
+            subset.append(particle)
+            #self.info("micId: %03d, particle: %05s, size: %s"
+            #          % (micId, partId, subset.getSize()))
+            self._lastPartId = partId
+            # Check the following after finding particles of a new micrograph
+            if micId != self._lastMicId:
+                batchSize = self._getBatchSize()
+                self._lastMicId = micId
+                if self._lastMicId is not None and subset.getSize() > batchSize:
+                    print("Subset size:", subset.getSize())
+                    print("Batch size:", batchSize)
+                    self._writeSubset(subset)
+                    subset = self._createSubset()
+                    if self.cumulative.get():
+                        print("Cumulative is set to true, restarting from particle ",self.startingNumber.get())
+                        self._lastPartId = self.startingNumber.get()
+                    self._saveCursor()
+                    if self.cumulative.get():
+                        break
+
+        # Write last group of particles if input stream is closed
+        if self._streamClosed:
+            self._writeSubset(subset)
+
+        self._subset = subset
+
+    def _loadCursor(self):
+        """ Restore the position in the input set saved by a previous
+        execution, or start from the beginning if the protocol is restarted. """
+        if getattr(self, '_originalRunMode', None) == MODE_RESTART:
+            self._cursorPartId.set(None)
+            self._cursorMicId.set(None)
+            self._cursorBatches.set(0)
+            self._cursorBatchSize.set(0)
+            self._runIds.clear()
+        self._counter = self._cursorBatches.get()
+        self._lastMicId = self._cursorMicId.get()
+        self._lastPartId = self._cursorPartId.get(self.startingNumber.get())
+        if self._isBalancedCumulative():
+            # The sampled particles are not stored, read them again
+            self._lastPartId = self.startingNumber.get()
+        self._lastBatchSize = self._cursorBatchSize.get()
+        if self._counter:
+            self.info("Resuming after batch %03d from particle %d"
+                      % (self._counter, self._lastPartId))
+
+    def _saveCursor(self):
+        """ Store the position in the input set after the last written batch. """
+        self._cursorPartId.set(self._lastPartId)
+        self._cursorMicId.set(self._lastMicId)
+        # The current subset has not been written yet
+        self._cursorBatches.set(self._counter - 1)
+        self._cursorBatchSize.set(self._lastBatchSize)
+        self._store(self._cursorPartId, self._cursorMicId,
+                    self._cursorBatches, self._cursorBatchSize, self._runIds)
+
+    def _getBatchSize(self):
+        """ Number of particles the current subset needs to reach
+        before it is written and a new classification is scheduled. """
+        if self.batchPolicy.get() == self.BATCH_ADAPTIVE:
+            newParticles = adaptiveBatchSize(self._arrivalRate.rate,
+                                             self.samplingInterval.get() * 60,
+                                             self._pendingRuns,
+                                             self.minBatchSize.get(),
+                                             self.maxBatchSize.get(),
+                                             self.parallelRuns.get())
+            return self._lastBatchSize * self.cumulative.get() + newParticles
+        return int(self.batchSize)*self.cumulative.get()*self._counter + int(self.batchSize)*(not self.cumulative.get())
+
+    def _waitForNewInput(self, interval):
+        """ Wait until enough new particles for the next batch are
+        available, the input stream is closed or the interval is over. """
+        if self.samplingMode.get() == self.SAMPLING_BALANCED:
+            currentSize = len(self._reservoir)
+        else:
+            currentSize = self._subset.getSize()
+        missing = max(self._getBatchSize() - currentSize, 1)
+        self._inputProbe.waitForItems(self._lastPartId, missing, interval,
+                                      self.probeInterval.get())
+
+    def _getGpuGroups(self):
+        """ Return the list of GPU ids strings, one per chain of runs. """
+        return [g.strip() for g in self.gpuGroups.get('').split('|')
+                if g.strip()]
+
+    def _countPendingRuns(self):
+        """ Count the scheduled copies of the template protocol
+        that have not finished yet. """
+        runIds = self._runPrerequisites + list(self._runIds)
+        if not runIds:
+            return 0
+        project = Manager().loadProject(self.getProject().getName())
+        pending = 0
+        for runId in runIds:
+            try:
+                if project.getProtocol(runId).isActive():
+                    pending += 1
+            except Exception:
+                # The run may have been deleted by the user
+                pass
+        return pending
+
+    def _checkNewInputBalanced(self):
+        """ Same as _checkNewInput, but the batches are taken from the
+        particles sampled for every micrograph. In cumulative mode the
+        sampled particles are kept between batches. """
+        reservoir = self._reservoir
+        for particle in self._iterParticles(orderBy='id'):
+            micId = particle.getMicId()
+            reservoir.add(micId, particle.clone())
+            self._lastPartId = particle.getObjId()
+            if micId != self._lastMicId:
+                batchSize = self._getBatchSize()
+                self._lastMicId = micId
+                if len(reservoir) > batchSize:
+                    print("Sampled particles:", len(reservoir))
+                    print("Batch size:", batchSize)
+                    self._writeSubset(self._fillSubset(self._subset))
+                    if not self.cumulative.get():
+                        reservoir.clear()
+                    self._subset = self._createSubset()
+                    self._saveCursor()
+
+        if self._streamClosed:
+            self._writeSubset(self._fillSubset(self._subset))
+
+    def _fillSubset(self, subset):
+        for particle in self._reservoir:
+            subset.append(particle)
+        return subset
+
+    def _getMetricsFile(self):
+        return self._getExtraPath('streamer_metrics.jsonl')
+
+    def _isBalancedCumulative(self):
+        return (self.samplingMode.get() == self.SAMPLING_BALANCED and
+                self.cumulative.get())
+
+    def _iterParticles(self, orderBy=['_micId', 'id']):
+        inputParts = self.inputParticles.get()
+        inputParts.load()
+        inputParts.loadAllProperties()
+        self._streamClosed = inputParts.isStreamClosed()
+        self._arrivalRate.update(inputParts.getSize())
+
+        for p in inputParts.iterItems(orderBy=orderBy,
+                                      direction='ASC',
+                                      where='id > %d' % self._lastPartId):
+            self._metrics.particleScanned(p.getObjId(), p.getObjCreation())
+            yield p
+
+        inputParts.close()
+
+    # --------------------------- INFO functions -----------------------------
+    def _summary(self):
+        summary = ['Classification runs scheduled: %d' % len(self._runIds)]
+        metrics = StreamerMetrics.readLast(self._getMetricsFile())
+        if metrics is not None:
+            summary.append('Last check (%s): %d particles scanned in %0.1f s, '
+                           'subsets written in %0.1f s, runs scheduled in '
+                           '%0.1f s' % (metrics['time'], metrics['scanned'],
+                                        metrics['scanTime'],
+                                        metrics['writeTime'],
+                                        metrics['scheduleTime']))
+            summary.append('Pending classification runs: %d'
+                           % metrics['pendingRuns'])
+            if metrics['batchLatency']:
+                summary.append('Time from particle arrival to batch (s): %s'
+                               % ', '.join(map(str, metrics['batchLatency'])))
+            summary.append('All metrics: %s' % self._getMetricsFile())
+        return summary
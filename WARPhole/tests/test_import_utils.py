@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from WARPhole.protocols import import_utils
+from WARPhole.protocols.import_utils import (ColumnarSidecar, CommitPolicy,
+                                             ImportSession, SharedBinaryCache,
+                                             StarRowReader, listSidecarChunks,
+                                             loadSidecarColumns, readStarHeader,
+                                             _parseStarChunk, _starValue)
+
+
+OPTICS_BLOCK = '''
+# version 30001
+
+data_optics
+
+loop_
+_rlnOpticsGroupName #1
+_rlnOpticsGroup #2
+_rlnImagePixelSize #3
+_rlnImageSize #4
+opticsGroup1 1 1.0800 256
+opticsGroup2 2 1.0800 256
+
+'''
+
+PARTICLES_HEADER = '''
+# version 30001
+
+data_particles
+
+loop_
+_rlnImageName #1
+_rlnMicrographName #2
+_rlnCoordinateX #3
+_rlnDefocusU #4
+_rlnOpticsGroup #5
+'''
+
+RELION30_HEADER = '''
+data_
+
+loop_
+_rlnImageName #1
+_rlnMicrographName #2
+_rlnCoordinateX #3
+_rlnDefocusU #4
+_rlnOpticsGroup #5
+'''
+
+
+def starRow(i):
+    return '%06d@particles/mic%03d.mrcs mic%03d.tif %d.5 %d 1\n' % (i % 1000 + 1, i // 1000, i // 1000, i, 10000 + i)
+
+
+class TestImportSession(unittest.TestCase):
+
+    def test_idleTimeout(self):
+        session = ImportSession(10, 60, now=0)
+        session.update(5, 100., now=10)
+        self.assertFalse(session.isFinished(now=69))
+        # A new modification time is activity, even without new particles
+        session.update(0, 200., now=50)
+        self.assertEqual(session.idleTime(now=70), 20)
+        self.assertFalse(session.isFinished(now=109))
+        # The same modification time is not
+        session.update(0, 200., now=100)
+        self.assertTrue(session.isFinished(now=110))
+
+    def test_backoffCap(self):
+        session = ImportSession(10, 1000, maxInterval=60, now=0)
+        waits = []
+        for now in range(1, 7):
+            session.update(0, None, now=now)
+            waits.append(session.nextInterval(now=now))
+        self.assertEqual(waits, [20, 40, 60, 60, 60, 60])
+        session.update(1, None, now=7)
+        self.assertEqual(session.nextInterval(now=7), 10)
+
+    def test_lastReadAtTimeout(self):
+        session = ImportSession(10, 100, maxInterval=60, now=0)
+        for now in range(5):
+            session.update(0, None, now=now)
+        self.assertEqual(session.nextInterval(now=90), 10)
+        self.assertEqual(session.nextInterval(now=120), 0)
+
+    def test_noInterval(self):
+        self.assertTrue(ImportSession(0, 100, now=0).isFinished(now=0))
+
+
+class TestCommitPolicy(unittest.TestCase):
+
+    def test_rowsFirst(self):
+        policy = CommitPolicy(rows=100, interval=60, now=0)
+        policy.add(99)
+        self.assertFalse(policy.isDue(now=10))
+        policy.add(1)
+        self.assertTrue(policy.isDue(now=10))
+        policy.committed(now=10)
+        self.assertEqual(policy.pending, 0)
+        self.assertFalse(policy.isDue(now=100))
+
+    def test_secondsFirst(self):
+        policy = CommitPolicy(rows=100, interval=60, now=0)
+        policy.add(1)
+        self.assertFalse(policy.isDue(now=59))
+        self.assertTrue(policy.isDue(now=60))
+        policy.committed(now=60)
+        policy.add(1)
+        self.assertFalse(policy.isDue(now=119))
+        self.assertTrue(policy.isDue(now=120))
+
+    def test_singleLimit(self):
+        rows = CommitPolicy(rows=10, now=0)
+        rows.add(5)
+        self.assertFalse(rows.isDue(now=1000))
+        seconds = CommitPolicy(interval=30, now=0)
+        seconds.add(1000)
+        self.assertFalse(seconds.isDue(now=29))
+        self.assertTrue(seconds.isDue(now=30))
+
+    def test_everyRead(self):
+        policy = CommitPolicy(now=0)
+        self.assertFalse(policy.isDue(now=0))
+        policy.add(1)
+        self.assertTrue(policy.isDue(now=0))
+
+
+class TestStarValues(unittest.TestCase):
+
+    def test_starValue(self):
+        self.assertEqual(_starValue('12'), 12)
+        self.assertIsInstance(_starValue('12'), int)
+        self.assertEqual(_starValue('1.5'), 1.5)
+        self.assertEqual(_starValue('1e4'), 10000.)
+        self.assertEqual(_starValue('mic001.tif'), 'mic001.tif')
+
+    def test_parseStarChunk(self):
+        labels = ['rlnImageName', 'rlnMicrographName', 'rlnCoordinateX',
+                  'rlnDefocusU', 'rlnOpticsGroup']
+        data = (starRow(1) + '\n# comment\n' + '1 2 3\n' + starRow(2)).encode()
+        columns, badLines = _parseStarChunk(data, labels)
+        self.assertEqual(badLines, 1)
+        self.assertEqual(columns[0], ['000002@particles/mic000.mrcs',
+                                      '000003@particles/mic000.mrcs'])
+        # Names are kept as text, even if they look like numbers
+        self.assertEqual(_parseStarChunk(b'0001 0002 1 2 1\n', labels)[0][:2],
+                         [['0001'], ['0002']])
+        self.assertEqual(columns[2], [1.5, 2.5])
+        self.assertEqual(columns[4], [1, 1])
+
+
+class TestStarRowReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, 'goodparticles.star')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, text, mode='w'):
+        with open(self.fileName, mode) as f:
+            f.write(text)
+
+    def _rows(self, first, count):
+        return ''.join(starRow(i) for i in range(first, first + count))
+
+    def _coordinates(self, rows):
+        return [row['rlnCoordinateX'] for row in rows]
+
+    def test_opticsAndParticles(self):
+        self._write(OPTICS_BLOCK + PARTICLES_HEADER + self._rows(0, 3))
+        rows = StarRowReader(self.fileName).readNewRows()
+        self.assertEqual(self._coordinates(rows), [0.5, 1.5, 2.5])
+        self.assertEqual(rows[0]['rlnMicrographName'], 'mic000.tif')
+        self.assertEqual(rows[0]['rlnDefocusU'], 10000)
+        header = readStarHeader(self.fileName)
+        self.assertEqual([g['rlnOpticsGroup'] for g in header.optics], [1, 2])
+        self.assertEqual(header.columns[0], 'rlnImageName')
+        self.assertEqual(header.firstRow['rlnCoordinateX'], 0.5)
+
+    def test_relion30(self):
+        self._write(RELION30_HEADER + self._rows(0, 2))
+        rows = StarRowReader(self.fileName).readNewRows()
+        self.assertEqual(self._coordinates(rows), [0.5, 1.5])
+        self.assertEqual(readStarHeader(self.fileName).optics, [])
+
+    def test_halfWrittenLine(self):
+        reader = StarRowReader(self.fileName)
+        line = starRow(2)
+        self._write(PARTICLES_HEADER + self._rows(0, 2) + line[:10])
+        self.assertEqual(self._coordinates(reader.readNewRows()), [0.5, 1.5])
+        self.assertEqual(reader.badLines, 0)
+        self.assertEqual(reader.readNewRows(), [])
+        self._write(line[10:] + self._rows(3, 1), 'a')
+        self.assertEqual(self._coordinates(reader.readNewRows()), [2.5, 3.5])
+
+    def test_headerWithoutRows(self):
+        reader = StarRowReader(self.fileName)
+        self._write(OPTICS_BLOCK + PARTICLES_HEADER)
+        self.assertEqual(reader.readNewRows(), [])
+        self._write(self._rows(0, 2), 'a')
+        self.assertEqual(self._coordinates(reader.readNewRows()), [0.5, 1.5])
+
+    def test_badLines(self):
+        reader = StarRowReader(self.fileName)
+        self._write(PARTICLES_HEADER + self._rows(0, 1) + '1 2 3\n' + self._rows(1, 1))
+        self.assertEqual(self._coordinates(reader.readNewRows()), [0.5, 1.5])
+        self.assertEqual(reader.badLines, 1)
+
+    def test_truncatedInPlace(self):
+        reader = StarRowReader(self.fileName)
+        self._write(PARTICLES_HEADER + self._rows(0, 5))
+        self.assertEqual(len(reader.readNewRows()), 5)
+        # Same inode, shorter file
+        self._write(PARTICLES_HEADER + self._rows(10, 2))
+        self.assertEqual(self._coordinates(reader.readNewRows()), [10.5, 11.5])
+
+    def test_rewrittenInPlace(self):
+        reader = StarRowReader(self.fileName)
+        self._write(PARTICLES_HEADER + self._rows(0, 3))
+        self.assertEqual(len(reader.readNewRows()), 3)
+        # Same inode and at least the same size, but other rows
+        self._write(PARTICLES_HEADER + self._rows(100, 4))
+        self.assertEqual(self._coordinates(reader.readNewRows()),
+                         [100.5, 101.5, 102.5, 103.5])
+
+    def test_replacedFile(self):
+        reader = StarRowReader(self.fileName)
+        self._write(PARTICLES_HEADER + self._rows(0, 3))
+        self.assertEqual(len(reader.readNewRows()), 3)
+        tmpName = self.fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            f.write(PARTICLES_HEADER + self._rows(0, 4))
+        os.replace(tmpName, self.fileName)
+        self.assertEqual(len(reader.readNewRows()), 4)
+
+    def test_parallelParsing(self):
+        rows = self._rows(0, 2000) + '1 2 3\n' + '\n# comment\n' + self._rows(2000, 500)
+        self._write(OPTICS_BLOCK + PARTICLES_HEADER + rows)
+        sequential = StarRowReader(self.fileName)
+        expected = sequential.readNewRows()
+        with mock.patch.object(import_utils, 'PARALLEL_PARSE_SIZE', 1024), \
+                mock.patch.object(import_utils.os, 'cpu_count', return_value=4), \
+                mock.patch.object(StarRowReader, '_parseRowsParallel',
+                                  autospec=True,
+                                  side_effect=StarRowReader._parseRowsParallel) as parallel:
+            reader = StarRowReader(self.fileName)
+            self.assertEqual(reader.readNewRows(), expected)
+            self.assertTrue(parallel.called)
+        self.assertEqual(len(expected), 2500)
+        self.assertEqual(reader.badLines, sequential.badLines)
+        self.assertEqual(reader.badLines, 1)
+
+    def test_brokenPool(self):
+        rows = '1 2 3\n' + self._rows(0, 2000)
+        self._write(OPTICS_BLOCK + PARTICLES_HEADER + self._rows(0, 1) + rows)
+        expected = StarRowReader(self.fileName).readNewRows()
+
+        class BrokenPool:
+            # Parses the first chunk, then the pool breaks
+            def __init__(self, max_workers):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def map(self, fn, *iterables):
+                for i, args in enumerate(zip(*iterables)):
+                    if i:
+                        raise import_utils.BrokenProcessPool()
+                    yield fn(*args)
+
+        with mock.patch.object(import_utils, 'PARALLEL_PARSE_SIZE', 1024), \
+                mock.patch.object(import_utils.os, 'cpu_count', return_value=4), \
+                mock.patch.object(import_utils, 'ProcessPoolExecutor', BrokenPool):
+            reader = StarRowReader(self.fileName)
+            self.assertEqual(reader.readNewRows(), expected)
+        # The bad line of the first chunk is only counted by the sequential parse
+        self.assertEqual(reader.badLines, 1)
+
+
+class TestColumnarSidecar(unittest.TestCase):
+
+    COLUMNS = ['rlnImageName', 'rlnDefocusU']
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpDir, 'columns')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _rows(self, first, count):
+        return [['%06d@stack.mrcs' % i, 10000. + i]
+                for i in range(first, first + count)]
+
+    def _names(self):
+        names = loadSidecarColumns(self.path, ['rlnImageName'])
+        return [n.decode() for n in names.get('rlnImageName', [])]
+
+    def test_appendAndReopen(self):
+        sidecar = ColumnarSidecar(self.path)
+        sidecar.append(self.COLUMNS, self._rows(1, 3))
+        sidecar.append(self.COLUMNS, self._rows(4, 2))
+        sidecar = ColumnarSidecar(self.path)
+        self.assertEqual(sidecar.rows, 5)
+        sidecar.append(self.COLUMNS, self._rows(6, 1))
+        columns = loadSidecarColumns(self.path)
+        self.assertEqual(self._names(), ['%06d@stack.mrcs' % i for i in range(1, 7)])
+        self.assertEqual(list(columns['rlnDefocusU']), [10000. + i for i in range(1, 7)])
+
+    def test_compaction(self):
+        factor = import_utils.SIDECAR_MERGE_FACTOR
+        sidecar = ColumnarSidecar(self.path)
+        for i in range(factor ** 3):
+            sidecar.append(self.COLUMNS, self._rows(i, 1))
+        # Chunks of a similar size are merged in tiers
+        self.assertEqual(len(listSidecarChunks(self.path)), 1)
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        bigChunk = listSidecarChunks(self.path)[0]
+        for i in range(factor ** 3, factor ** 3 + factor - 1):
+            sidecar.append(self.COLUMNS, self._rows(i, 1))
+        # The big chunk is not rewritten for the small ones appended after it
+        chunks = listSidecarChunks(self.path)
+        self.assertEqual(chunks[0], bigChunk)
+        self.assertEqual(len(chunks), factor)
+        n = factor ** 3 + factor - 1
+        self.assertEqual(ColumnarSidecar(self.path).rows, n)
+        self.assertEqual(self._names(), ['%06d@stack.mrcs' % i for i in range(n)])
+
+    def test_interruptedCompaction(self):
+        sidecar = ColumnarSidecar(self.path)
+        sidecar.append(self.COLUMNS, self._rows(0, 2))
+        sidecar.append(self.COLUMNS, self._rows(2, 2))
+        oldChunks = listSidecarChunks(self.path)
+        # The merged chunk was written, but the old ones were not removed
+        columns = loadSidecarColumns(self.path)
+        sidecar._writeChunk(0, 0, 4, [(label, [column])
+                                      for label, column in columns.items()])
+        self.assertTrue(all(os.path.exists(c) for c in oldChunks))
+        self.assertEqual(len(listSidecarChunks(self.path)), 1)
+        self.assertEqual(self._names(), ['%06d@stack.mrcs' % i for i in range(4)])
+        sidecar = ColumnarSidecar(self.path)
+        self.assertEqual(sidecar.rows, 4)
+        self.assertFalse(any(os.path.exists(c) for c in oldChunks))
+
+    def test_truncate(self):
+        sidecar = ColumnarSidecar(self.path)
+        sidecar.append(self.COLUMNS, self._rows(0, 3))
+        sidecar.append(self.COLUMNS, self._rows(3, 3))
+        sidecar.truncate(4)
+        self.assertEqual(self._names(), ['%06d@stack.mrcs' % i for i in range(4)])
+        sidecar.append(self.COLUMNS, self._rows(4, 1))
+        self.assertEqual(ColumnarSidecar(self.path).rows, 5)
+        sidecar.truncate(0)
+        self.assertEqual(self._names(), [])
+        sidecar = ColumnarSidecar(self.path)
+        self.assertEqual(sidecar.rows, 0)
+        sidecar.append(self.COLUMNS, self._rows(7, 1))
+        self.assertEqual(self._names(), ['000007@stack.mrcs'])
+
+
+class TestSharedBinaryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self.tmpDir, 'cache')
+        self.source = os.path.join(self.tmpDir, 'particles.mrcs')
+        with open(self.source, 'wb') as f:
+            f.write(b'\0' * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _owner(self, name):
+        owner = os.path.join(self.tmpDir, name)
+        os.makedirs(owner)
+        return owner
+
+    def test_fetchOnce(self):
+        first = SharedBinaryCache(self.cachePath, self._owner('p1'))
+        second = SharedBinaryCache(self.cachePath, self._owner('p2'))
+        cached = first.fetch(self.source)
+        self.assertEqual(second.fetch(self.source), cached)
+        with open(cached, 'rb') as f:
+            self.assertEqual(len(f.read()), 1024)
+
+    def test_collectOnlyOwnersOfThisHost(self):
+        owner = self._owner('p1')
+        cached = SharedBinaryCache(self.cachePath, owner, host='node1').fetch(self.source)
+        shutil.rmtree(owner)
+        # Another host cannot tell if the owner folder still exists
+        self.assertEqual(SharedBinaryCache(self.cachePath, owner, host='node2').collect(), 0)
+        self.assertTrue(os.path.exists(cached))
+        self.assertEqual(SharedBinaryCache(self.cachePath, owner, host='node1').collect(), 1)
+        self.assertFalse(os.path.exists(cached))
+
+    def test_collectKeepsUsedEntries(self):
+        owner = self._owner('p1')
+        other = self._owner('p2')
+        cached = SharedBinaryCache(self.cachePath, owner).fetch(self.source)
+        SharedBinaryCache(self.cachePath, other).fetch(self.source)
+        shutil.rmtree(owner)
+        self.assertEqual(SharedBinaryCache(self.cachePath, other).collect(), 0)
+        self.assertTrue(os.path.exists(cached))
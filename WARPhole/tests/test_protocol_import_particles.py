@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+import os
+import subprocess
+import sys
+import unittest
+
+import WARPhole
+
+# Modules that are only needed when the import runs
+RUN_MODULES = ['relion.convert', 'emtable']
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def _importedModules(self, module):
+        '''Names of all the modules loaded by importing module in a new interpreter'''
+        root = os.path.dirname(os.path.dirname(os.path.abspath(WARPhole.__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in
+                                                      [env.get('PYTHONPATH')] if p])
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                 'import ' + module], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode:
+            frames = [line for line in result.stderr.splitlines()
+                      if line.strip().startswith('File ')]
+            # Broken dependencies of the plugin, not the plugin itself
+            if frames and 'WARPhole' not in frames[-1]:
+                self.skipTest(result.stderr.splitlines()[-1])
+            self.fail(result.stderr)
+        return set(line.split('|')[-1].strip() for line in result.stderr.splitlines()
+                   if line.startswith('import time:'))
+
+    def test_importParticlesProtocol(self):
+        modules = self._importedModules('WARPhole.protocols.protocol_import_particles')
+        self.assertIn('WARPhole.protocols.protocol_import_particles', modules)
+        for name in RUN_MODULES:
+            self.assertFalse([m for m in modules if m == name or m.startswith(name + '.')],
+                             "%s is loaded with the protocol" % name)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from WARPhole.protocols import scratch_utils
+from WARPhole.protocols.scratch_utils import (MrcStackReader, StagingManifest,
+                                              StagingTransform, fastCopyFile,
+                                              getStagedFilename, rankScratchRoots,
+                                              repackImages, transformStack)
+
+
+def writeStack(fileName, images, pixelSize=1.0, nsymbt=0):
+    '''Write a little-endian float32 MRC stack with the given images'''
+    images = np.asarray(images, dtype='<f4')
+    nz, ny, nx = images.shape
+    header = bytearray(1024)
+    struct.pack_into('<4i', header, 0, nx, ny, nz, 2)
+    struct.pack_into('<3i', header, 28, nx, ny, nz)
+    struct.pack_into('<3f', header, 40, nx * pixelSize, ny * pixelSize,
+                     nz * pixelSize)
+    struct.pack_into('<i', header, 92, nsymbt)
+    header[212:214] = b'\x44\x44'
+    with open(fileName, 'wb') as f:
+        f.write(header)
+        f.write(bytes(nsymbt))
+        f.write(images.tobytes())
+
+
+def readStack(fileName):
+    '''Header values (nx, ny, nz, mode, mz, cell lengths) and images of a stack'''
+    with open(fileName, 'rb') as f:
+        header = f.read(1024)
+        nx, ny, nz, mode = struct.unpack_from('<4i', header, 0)
+        mz, = struct.unpack_from('<i', header, 36)
+        cell = struct.unpack_from('<3f', header, 40)
+        nsymbt, = struct.unpack_from('<i', header, 92)
+        f.seek(1024 + nsymbt)
+        dtype = '<f2' if mode == 12 else '<f4'
+        images = np.frombuffer(f.read(), dtype=dtype).reshape(nz, ny, nx)
+    return (nx, ny, nz, mode, mz, cell), images
+
+
+class TestStagedFilename(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _stack(self, project):
+        # Same project-relative path in two projects
+        stack = os.path.join(self.tmpDir, project, 'Runs', '000002_Import',
+                             'extra', 'particles', 'stack.mrcs')
+        os.makedirs(os.path.dirname(stack))
+        open(stack, 'w').close()
+        return stack
+
+    def test_differentSources(self):
+        first, second = self._stack('p1'), self._stack('p2')
+        target = getStagedFilename(first, '/scratch')
+        self.assertNotEqual(target, getStagedFilename(second, '/scratch'))
+        self.assertTrue(target.startswith('/scratch/'))
+        self.assertEqual(os.path.basename(target), 'stack.mrcs')
+
+    def test_sameSource(self):
+        stack = self._stack('p1')
+        link = os.path.join(self.tmpDir, 'link.mrcs')
+        os.symlink(stack, link)
+        self.assertEqual(getStagedFilename(stack, '/scratch'),
+                         getStagedFilename(link, '/scratch'))
+
+    def test_variants(self):
+        stack = self._stack('p1')
+        plain = getStagedFilename(stack, '/scratch')
+        staged = getStagedFilename(stack, '/scratch', 'staged_box128')
+        self.assertNotEqual(plain, staged)
+        self.assertTrue(staged.startswith('/scratch/staged_box128/'))
+
+
+class TestRepackImages(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # Every image is filled with a different value
+        self.stackA = os.path.join(self.tmpDir, 'a.mrcs')
+        self.stackB = os.path.join(self.tmpDir, 'b.mrcs')
+        writeStack(self.stackA, [np.full((8, 8), v) for v in (1, 2, 3)],
+                   pixelSize=1.5, nsymbt=96)
+        writeStack(self.stackB, [np.full((8, 8), v) for v in (11, 12)],
+                   pixelSize=1.5)
+        self.prefix = os.path.join(self.tmpDir, 'repacked')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _value(self, location):
+        index, fileName = location
+        return readStack(fileName)[1][index - 1, 0, 0]
+
+    def test_indexMapping(self):
+        locations = [(2, self.stackB), (1, self.stackA), (3, self.stackA),
+                     (1, self.stackB), (2, self.stackA)]
+        newLocations = repackImages(locations, self.prefix, 1024**2)
+        self.assertEqual([self._value(loc) for loc in newLocations],
+                         [12, 1, 3, 11, 2])
+        # Every input stack is read in order into one new stack
+        self.assertEqual(newLocations[1], (1, self.prefix + '_001.mrcs'))
+        self.assertEqual(newLocations[0], (5, self.prefix + '_001.mrcs'))
+        (nx, ny, nz, mode, mz, cell), images = readStack(self.prefix + '_001.mrcs')
+        self.assertEqual((nx, ny, nz, mode, mz), (8, 8, 5, 2, 5))
+        self.assertEqual(cell, (12., 12., 7.5))
+        self.assertEqual(len(images), 5)
+
+    def test_maxStackSize(self):
+        locations = [(i, self.stackA) for i in (1, 2, 3)]
+        # Room for two images in every stack
+        newLocations = repackImages(locations, self.prefix, 1024 + 2 * 8 * 8 * 4)
+        self.assertEqual(newLocations, [(1, self.prefix + '_001.mrcs'),
+                                        (2, self.prefix + '_001.mrcs'),
+                                        (1, self.prefix + '_002.mrcs')])
+        header = readStack(self.prefix + '_002.mrcs')[0]
+        self.assertEqual(header[2], 1)
+        self.assertEqual(header[5][2], 1.5)
+        self.assertEqual([self._value(loc) for loc in newLocations], [1, 2, 3])
+
+    def test_float16(self):
+        locations = [(1, self.stackB), (2, self.stackB)]
+        newLocations = repackImages(locations, self.prefix, 1024**2,
+                                    StagingTransform(float16=True))
+        (nx, ny, nz, mode, mz, cell), images = readStack(newLocations[0][1])
+        self.assertEqual((nx, ny, nz, mode), (8, 8, 2, 12))
+        self.assertEqual(images.dtype, np.float16)
+        self.assertEqual(os.path.getsize(newLocations[0][1]), 1024 + 2 * 8 * 8 * 2)
+        self.assertEqual([self._value(loc) for loc in newLocations], [11, 12])
+
+    def test_fourierCrop(self):
+        image = np.random.RandomState(0).normal(5., 1., (32, 32))
+        source = os.path.join(self.tmpDir, 'big.mrcs')
+        writeStack(source, [image], pixelSize=1.2)
+        newLocations = repackImages([(1, source)], self.prefix, 1024**2,
+                                    StagingTransform(box=16))
+        (nx, ny, nz, mode, mz, cell), images = readStack(newLocations[0][1])
+        self.assertEqual((nx, ny, nz, mode), (16, 16, 1, 2))
+        # The field of view is kept, so the pixel size doubles
+        self.assertAlmostEqual(cell[0] / nx, 2.4, places=5)
+        self.assertAlmostEqual(cell[1] / ny, 2.4, places=5)
+        self.assertAlmostEqual(float(images.mean()), image.mean(), places=4)
+
+
+class TestTransformStack(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpDir, 'source.mrcs')
+        self.target = os.path.join(self.tmpDir, 'target.mrcs')
+        self.images = np.arange(5 * 4 * 4, dtype=np.float32).reshape(5, 4, 4)
+        writeStack(self.source, self.images)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_chunkBoundaries(self):
+        # Two and a half images fit in a chunk
+        with mock.patch.object(scratch_utils, 'TRANSFORM_CHUNK_SIZE', 5 * 4 * 4 * 2), \
+             mock.patch.object(MrcStackReader, 'read', autospec=True,
+                               side_effect=MrcStackReader.read) as read:
+            transformStack(self.source, self.target, StagingTransform(float16=True))
+        self.assertEqual([c[0][1:] for c in read.call_args_list],
+                         [(1, 2), (3, 2), (5, 1)])
+        (nx, ny, nz, mode, mz, cell), images = readStack(self.target)
+        self.assertEqual((nx, ny, nz, mode, mz), (4, 4, 5, 12, 5))
+        np.testing.assert_array_equal(images, self.images.astype(np.float16))
+
+
+class TestStagingManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpDir, 'stack.mrcs')
+        self.target = os.path.join(self.tmpDir, 'scratch', 'stack.mrcs')
+        os.makedirs(os.path.dirname(self.target))
+        self._write(self.source, b'a' * 4096, 1000)
+        shutil.copyfile(self.source, self.target)
+        self.manifest = StagingManifest(os.path.dirname(self.target))
+        self.manifest.add(self.source, self.target)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, fileName, data, mtime):
+        with open(fileName, 'wb') as f:
+            f.write(data)
+        os.utime(fileName, (mtime, mtime))
+
+    def test_find(self):
+        self.assertEqual(self.manifest.find(self.source), self.target)
+        self.assertIsNone(self.manifest.find(self.source, 'staged_box128'))
+        other = StagingManifest(os.path.dirname(self.target))
+        self.assertEqual(other.find(self.source), self.target)
+        other.close()
+
+    def test_touchedSource(self):
+        # Same content with a new modification time
+        os.utime(self.source, (2000, 2000))
+        self.assertEqual(self.manifest.find(self.source), self.target)
+        with mock.patch.object(scratch_utils, 'quickChecksum') as checksum:
+            self.assertEqual(self.manifest.find(self.source), self.target)
+        checksum.assert_not_called()
+
+    def test_staleSource(self):
+        # Same size, new modification time and content
+        self._write(self.source, b'b' * 4096, 2000)
+        self.assertIsNone(self.manifest.find(self.source))
+
+    def test_resizedSource(self):
+        self._write(self.source, b'a' * 8192, 1000)
+        self.assertIsNone(self.manifest.find(self.source))
+
+    def test_missingTarget(self):
+        os.remove(self.target)
+        self.assertIsNone(self.manifest.find(self.source))
+
+    def test_reusedTarget(self):
+        other = os.path.join(self.tmpDir, 'other.mrcs')
+        self._write(other, b'c' * 4096, 1000)
+        self.manifest.add(other, self.target)
+        self.assertIsNone(self.manifest.find(self.source))
+        self.assertEqual(self.manifest.find(other), self.target)
+
+
+class TestFastCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpDir, 'stack.mrcs')
+        self.target = os.path.join(self.tmpDir, 'copy.mrcs')
+        with open(self.source, 'wb') as f:
+            f.write(b'stack' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _content(self):
+        with open(self.target, 'rb') as f:
+            return f.read()
+
+    def test_reflink(self):
+        with mock.patch.object(scratch_utils.fcntl, 'ioctl') as ioctl:
+            self.assertEqual(fastCopyFile(self.source, self.target), 'reflink')
+        self.assertEqual(ioctl.call_args[0][1], scratch_utils.FICLONE)
+
+    def test_hardlink(self):
+        with mock.patch.object(scratch_utils.fcntl, 'ioctl', side_effect=OSError):
+            self.assertEqual(fastCopyFile(self.source, self.target), 'hardlink')
+        self.assertTrue(os.path.samefile(self.source, self.target))
+
+    def test_copy(self):
+        with mock.patch.object(scratch_utils.fcntl, 'ioctl', side_effect=OSError), \
+             mock.patch.object(scratch_utils.os, 'link', side_effect=OSError):
+            self.assertEqual(fastCopyFile(self.source, self.target), 'copy')
+        self.assertFalse(os.path.samefile(self.source, self.target))
+        self.assertEqual(self._content(), b'stack' * 100)
+
+    def test_existingTarget(self):
+        with open(self.target, 'wb') as f:
+            f.write(b'old')
+        with mock.patch.object(scratch_utils.fcntl, 'ioctl', side_effect=OSError):
+            fastCopyFile(self.source, self.target)
+        self.assertEqual(self._content(), b'stack' * 100)
+
+
+class TestRankScratchRoots(unittest.TestCase):
+
+    ROOTS = ['/scratch1', '/scratch2', '/scratch3']
+
+    def _firsts(self, roots, weights, keys=3000):
+        return [rankScratchRoots('stack_%d.mrcs' % i, roots, weights)[0]
+                for i in range(keys)]
+
+    def test_stableRanking(self):
+        ranking = rankScratchRoots('stack.mrcs', self.ROOTS, [1, 1, 1])
+        self.assertEqual(sorted(ranking), self.ROOTS)
+        self.assertEqual(rankScratchRoots('stack.mrcs', self.ROOTS, [1, 1, 1]),
+                         ranking)
+        # The order of the roots in the input does not matter
+        self.assertEqual(rankScratchRoots('stack.mrcs', self.ROOTS[::-1],
+                                          [1, 1, 1]), ranking)
+
+    def test_weightedPlacement(self):
+        firsts = self._firsts(self.ROOTS, [1, 2, 5])
+        for root, share in zip(self.ROOTS, [1 / 8., 2 / 8., 5 / 8.]):
+            self.assertAlmostEqual(firsts.count(root) / float(len(firsts)),
+                                   share, delta=0.03)
+
+    def test_newRoot(self):
+        # Only the keys that go to a new root change their first root
+        before = self._firsts(self.ROOTS[:2], [1, 1])
+        after = self._firsts(self.ROOTS, [1, 1, 1])
+        moved = [new for old, new in zip(before, after) if old != new]
+        self.assertEqual(set(moved), {'/scratch3'})
+        self.assertAlmostEqual(len(moved) / float(len(before)), 1 / 3., delta=0.03)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from WARPhole.protocols.streaming_utils import (STREAM_CLOSED, InputProbe,
+                                                SetEvents, StreamerMetrics,
+                                                adaptiveBatchSize)
+
+
+def writeSetFile(fileName, items, streamState=None):
+    '''Write the tables of a set sqlite file used by the probes'''
+    conn = sqlite3.connect(fileName)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS Objects (id INTEGER PRIMARY KEY)")
+        conn.execute("CREATE TABLE IF NOT EXISTS Properties (key TEXT UNIQUE, value TEXT)")
+        conn.executemany("INSERT OR IGNORE INTO Objects VALUES (?)",
+                         [(i,) for i in range(1, items + 1)])
+        if streamState is not None:
+            conn.execute("INSERT OR REPLACE INTO Properties VALUES ('_streamState', ?)",
+                         (str(streamState),))
+    conn.close()
+
+
+class TestStreamerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, 'metrics.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_batchLatencyFromUtcCreation(self):
+        # Set items store their creation date in UTC, as sqlite
+        # datetime('now') does
+        creation = datetime.utcnow() - timedelta(seconds=120)
+        metrics = StreamerMetrics(self.fileName)
+        metrics.particleScanned(1, creation.strftime(StreamerMetrics.CREATION_FORMAT))
+        metrics.particleScanned(2, None)
+        metrics.batchWritten()
+        latency = metrics.values['batchLatency']
+        self.assertEqual(len(latency), 1)
+        self.assertAlmostEqual(latency[0], 120, delta=5)
+
+    def test_batchedParticlesAreNotCounted(self):
+        creation = (datetime.utcnow() - timedelta(hours=1)).strftime(
+            StreamerMetrics.CREATION_FORMAT)
+        metrics = StreamerMetrics(self.fileName, batchedId=10)
+        metrics.particleScanned(5, creation)
+        metrics.batchWritten()
+        self.assertEqual(metrics.values['batchLatency'], [])
+
+    def test_writeAndReadLast(self):
+        metrics = StreamerMetrics(self.fileName)
+        metrics.particleScanned(1, None)
+        metrics.write()
+        metrics.reset()
+        metrics.set('pendingRuns', 3)
+        metrics.write()
+        last = StreamerMetrics.readLast(self.fileName)
+        self.assertEqual(last['pendingRuns'], 3)
+        self.assertEqual(last['scanned'], 0)
+        with open(self.fileName) as f:
+            self.assertEqual(json.loads(f.readline())['scanned'], 1)
+
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+
+    def test_minimumWithoutRate(self):
+        self.assertEqual(adaptiveBatchSize(None, 600, 0, 5000, 50000), 5000)
+
+    def test_rateOverInterval(self):
+        self.assertEqual(adaptiveBatchSize(20, 600, 0, 5000, 50000), 12000)
+        self.assertEqual(adaptiveBatchSize(200, 600, 0, 5000, 50000), 50000)
+
+    def test_queuedRunsBeyondCapacity(self):
+        # One slot: every pending run makes the batch bigger
+        self.assertEqual(adaptiveBatchSize(None, 600, 2, 5000, 50000), 15000)
+        # Four slots: only the runs beyond the free slots count
+        self.assertEqual(adaptiveBatchSize(None, 600, 3, 5000, 50000, 4), 5000)
+        self.assertEqual(adaptiveBatchSize(None, 600, 4, 5000, 50000, 4), 10000)
+        self.assertEqual(adaptiveBatchSize(None, 600, 6, 5000, 50000, 4), 20000)
+
+
+class TestSetEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.setFile = os.path.join(self.tmpDir, 'particles.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _append(self, data):
+        with open(self.setFile + SetEvents.SUFFIX, 'ab') as f:
+            f.write(data)
+
+    def test_halfWrittenLine(self):
+        events = SetEvents(self.setFile)
+        self.assertEqual(events.read(), 0)
+        line = json.dumps({'lastId': 7, 'closed': True}).encode()
+        self._append(json.dumps({'lastId': 5, 'closed': False}).encode() + b'\n'
+                     + line[:10])
+        self.assertEqual(events.read(), 1)
+        self.assertEqual((events.lastId, events.closed), (5, False))
+        self.assertEqual(events.read(), 0)
+        self._append(line[10:] + b'\n')
+        self.assertEqual(events.read(), 1)
+        self.assertEqual((events.lastId, events.closed), (7, True))
+
+    def test_publish(self):
+        writeSetFile(self.setFile, 3)
+        producer, consumer = SetEvents(self.setFile), SetEvents(self.setFile)
+        producer.publish()
+        writeSetFile(self.setFile, 5)
+        producer.publish(closed=True)
+        with open(producer.fileName) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([(e['lastId'], e['newItems'], e['closed']) for e in events],
+                         [(3, 3, False), (5, 2, True)])
+        self.assertEqual(consumer.read(), 2)
+        self.assertEqual((consumer.lastId, consumer.closed), (5, True))
+
+
+class TestInputProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.setFile = os.path.join(self.tmpDir, 'particles.sqlite')
+        writeSetFile(self.setFile, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_polling(self):
+        probe = InputProbe(self.setFile)
+        self.assertEqual(probe.countNewItems(1), 3)
+        self.assertTrue(probe.waitForItems(1, 3, 0, 0.01))
+        self.assertFalse(probe.waitForItems(1, 4, 0, 0.01))
+        writeSetFile(self.setFile, 4, STREAM_CLOSED)
+        # The file changed, so it is queried again
+        os.utime(self.setFile, (1000, 1000))
+        self.assertTrue(probe.isStreamClosed())
+        self.assertTrue(probe.waitForItems(1, 10, 0, 0.01))
+
+    def test_unchangedFileIsNotQueried(self):
+        probe = InputProbe(self.setFile)
+        with mock.patch.object(probe, 'countNewItems', return_value=0) as count, \
+             mock.patch('time.sleep'):
+            self.assertFalse(probe.waitForItems(0, 1, 0.05, 0.01))
+        self.assertEqual(count.call_count, 1)
+
+    def test_events(self):
+        SetEvents(self.setFile).publish()
+        probe = InputProbe(self.setFile)
+        writeSetFile(self.setFile, 10)
+        # Only the events are read, and the new items were not announced yet
+        with mock.patch.object(probe, '_query') as query:
+            self.assertTrue(probe.waitForItems(0, 4, 0, 0.01))
+            self.assertFalse(probe.waitForItems(0, 5, 0, 0.01))
+            SetEvents(self.setFile).publish()
+            self.assertTrue(probe.waitForItems(0, 10, 0, 0.01))
+        query.assert_not_called()
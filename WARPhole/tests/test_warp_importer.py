@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Genis Valentin Gese (genis.valentin.gese@ki.se)
+# *
+# * Karolinska Institutet
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'genis.valentin.gese@ki.se'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from WARPhole.protocols import WARPimporter as importerModule
+from WARPhole.protocols.WARPimporter import WARPimporter
+from WARPhole.protocols.import_utils import getStarHeader
+
+
+STAR_HEADER = '''
+data_particles
+
+loop_
+_rlnImageName #1
+_rlnCoordinateX #2
+'''
+
+
+class FakeProtocol:
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+
+class FakeSet(list):
+
+    def setHasCTF(self, value):
+        pass
+
+
+class IncompleteStacks:
+    """ Stack validator for which the stacks named incomplete are not
+    written yet. """
+    def isComplete(self, path, index):
+        return 'incomplete' not in path
+
+
+class TestPendingRows(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, 'goodparticles.star')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeStar(self, rows):
+        # The file is replaced, as WARP does when it exports the particles again
+        tmpName = self.fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            f.write(STAR_HEADER)
+            for i, stack in rows:
+                f.write('%06d@particles/%s.mrcs %d\n' % (i, stack, i))
+        os.replace(tmpName, self.fileName)
+
+    def _createImporter(self):
+        # Only the attributes used to read the new particles are set
+        importer = WARPimporter.__new__(WARPimporter)
+        importer.protocol = FakeProtocol()
+        importer.partSet = FakeSet()
+        importer._imgDict = {}
+        importer._rowReader = None
+        importer._pendingRows = importerModule.OrderedDict()
+        importer._starHeader = getStarHeader(self.fileName)
+        importer._stackValidator = IncompleteStacks()
+        importer._imgPath = self.tmpDir
+        importer._sidecar = None
+        importer._linker = mock.Mock()
+        importer.preprocess_success = True
+        return importer
+
+    def _read(self, importer):
+        with mock.patch.object(importerModule, 'rowToParticle',
+                               side_effect=lambda row, **kwargs: mock.Mock()):
+            return importer.readSetOfNewParticles(self.fileName)
+
+    def test_replacedFileWithIncompleteStack(self):
+        rows = [(1, 'complete'), (2, 'complete'),
+                (1, 'incomplete'), (2, 'incomplete')]
+        self._writeStar(rows)
+        importer = self._createImporter()
+        self.assertEqual(len(self._read(importer)), 2)
+        self.assertEqual(importer.countPendingRows(), 2)
+        # Read again from the start, with the pending rows among them
+        self._writeStar(rows + [(3, 'complete')])
+        self.assertEqual(self._read(importer), {'000003@particles/complete.mrcs'})
+        self.assertEqual(importer.countPendingRows(), 2)
+        self._writeStar(rows + [(3, 'complete')])
+        self.assertEqual(self._read(importer), set())
+        self.assertEqual(importer.countPendingRows(), 2)
+        self.assertEqual(len(importer.partSet), 3)